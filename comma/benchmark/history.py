@@ -0,0 +1,86 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+"""
+Benchmark path-limited history queries with and without commit-graph Bloom filters
+
+Usage: python -m comma.benchmark.history [--repo NAME] [--section SECTION ...]
+"""
+
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser
+from typing import Dict, Optional, Sequence
+
+from comma.util.tracking import Repo
+
+
+DEFAULT_SECTIONS = ("Hyper-V/Azure CORE AND DRIVERS",)
+
+# Git configuration for each scenario
+SCENARIOS: Dict[str, Sequence[str]] = {
+    "no commit-graph": ("-c", "core.commitGraph=false"),
+    "commit-graph": ("-c", "commitGraph.readChangedPaths=false"),
+    "commit-graph + Bloom filters": (),
+}
+
+
+def time_command(command: Sequence[str], repeat: int) -> float:
+    """
+    Get the best wall time for a command in seconds
+    """
+
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(command, stdout=subprocess.DEVNULL, check=True)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best
+
+
+def main(args: Optional[Sequence[str]] = None):
+    """
+    Run benchmark and print results
+    """
+
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--repo", default="linux", help="Name of repo under Repos directory")
+    parser.add_argument("--ref", default="origin/master", help="Reference to query")
+    parser.add_argument(
+        "--section",
+        action="append",
+        dest="sections",
+        help=f"MAINTAINERS section to track, may be repeated. Defaults to {DEFAULT_SECTIONS}",
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per query, best is reported")
+    options = parser.parse_args(args)
+
+    repo = Repo(options.repo, url="")
+    if not repo.exists:
+        sys.exit(f"Repo '{options.repo}' does not exist, run comma first to clone it")
+    if repo.is_shallow:
+        sys.exit(f"Repo '{options.repo}' is shallow, git does not use commit-graphs for it")
+
+    paths = repo.get_tracked_paths(options.sections or DEFAULT_SECTIONS)
+    repo.write_commit_graph()
+
+    queries = {
+        "rev-list": ("rev-list", "--no-merges", options.ref, "--", *paths),
+        "log --format=%H": ("log", "--no-merges", "--format=%H", options.ref, "--", *paths),
+    }
+
+    print(f"{len(paths)} tracked paths, best of {options.repeat} runs")
+    for query, query_args in queries.items():
+        baseline = None
+        for scenario, config in SCENARIOS.items():
+            elapsed = time_command(
+                ("git", "-C", str(repo.path), *config, *query_args), options.repeat
+            )
+            baseline = baseline or elapsed
+            print(f"{query:<16} {scenario:<30} {elapsed:8.3f}s {baseline / elapsed:6.1f}x")
+
+
+if __name__ == "__main__":
+    main()
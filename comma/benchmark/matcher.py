@@ -0,0 +1,394 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+"""
+Benchmark downstream matching implementations and compare their verdicts
+
+Usage: python -m comma.benchmark.matcher [--upstream N] [--downstream N] [--seed N]
+       python -m comma.benchmark.matcher --replay SNAPSHOT
+       python -m comma.benchmark.matcher --database comma.db --reference REF --record SNAPSHOT
+
+By default, synthetic corpora are generated. A corpus can be recorded to a SQLite snapshot
+with --record and replayed later with --replay. A real corpus is built from the upstream
+patches in a local comma SQLite database and the downstream history of a local repo.
+"""
+
+import random
+import sys
+import time
+import tracemalloc
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+import sqlalchemy
+from sqlalchemy.orm import Session, undefer
+
+from comma.database.model import PatchData
+from comma.downstream.matcher import (
+    BATCH_AVAILABLE,
+    ConfidenceBounds,
+    DownstreamIndex,
+    find_match,
+    get_filepaths,
+    match_patches,
+)
+from comma.util.cache import DiskCache
+from comma.util.history import PATCH_DATA_FIELDS, PatchRecord
+from comma.util.tracking import Repo
+
+
+DEFAULT_SECTIONS = ("Hyper-V/Azure CORE AND DRIVERS",)
+BASELINE = "exhaustive"
+
+# Synthetic corpus settings
+BACKPORT_FRACTION = 0.5  # Fraction of upstream patches with a downstream equivalent
+EPOCH = datetime(2020, 1, 1)
+WORDS = tuple(
+    "add allocate avoid buffer channel check cleanup clock device disable driver enable error "
+    "fix free handle interrupt leak memory message null offer path race remove reset ring "
+    "support timeout update use vmbus".split()
+)
+PREFIXES = ("Drivers: hv: ", "hv_netvsc: ", "PCI: hv: ", "x86/hyperv: ", "scsi: storvsc: ")
+FILES = tuple(
+    f"{directory}/{name}.c"
+    for directory in ("drivers/hv", "drivers/net/hyperv", "drivers/pci/controller", "arch/x86")
+    for name in ("channel", "connection", "core", "hv", "ring_buffer", "utils", "vmbus")
+)
+
+
+class Corpus(NamedTuple):
+    """Upstream patches to match and downstream patches to match them against"""
+
+    upstream: List[PatchRecord]
+    downstream: List[PatchRecord]
+
+
+class Result(NamedTuple):
+    """Outcome of matching a corpus with one implementation"""
+
+    verdicts: List[Optional[str]]
+    elapsed: float
+    peak_memory: int
+
+
+def make_sentence(rand: random.Random, count: int) -> str:
+    """Generate a sentence of random words"""
+
+    return " ".join(rand.choice(WORDS) for _ in range(count))
+
+
+def make_diff(rand: random.Random, filenames: Sequence[str]) -> str:
+    """Generate diffs in the format of PatchData.commitDiffs"""
+
+    diffs = []
+    for filename in filenames:
+        diffs.append(filename)
+        for _ in range(rand.randint(2, 30)):
+            diffs.append(f"{rand.choice('+-')}\t{make_sentence(rand, rand.randint(2, 8))};")
+
+    return "\n".join(diffs)
+
+
+def make_upstream(rand: random.Random, num: int) -> PatchRecord:
+    """Generate an upstream patch, possibly touching multiple files"""
+
+    author = f"Developer {rand.randrange(50)}"
+    author_time = EPOCH + timedelta(minutes=rand.randrange(525600))
+    filenames = rand.sample(FILES, rand.choice((1, 1, 1, 2, 3, 5)))
+    return PatchRecord(
+        commitID=f"{rand.getrandbits(128):032x}{num:08x}",
+        subject=rand.choice(PREFIXES) + make_sentence(rand, rand.randint(3, 10)),
+        description=make_sentence(rand, rand.randint(10, 60)),
+        author=author,
+        authorEmail=f"{author.replace(' ', '.').lower()}@example.com",
+        authorTime=author_time,
+        commitTime=author_time + timedelta(hours=rand.randrange(1, 24 * 14)),
+        affectedFilenames=" ".join(filenames),
+        commitDiffs=make_diff(rand, filenames),
+        fixedPatches="",
+    )
+
+
+def make_backport(rand: random.Random, upstream: PatchRecord, num: int) -> PatchRecord:
+    """
+    Generate a downstream equivalent of an upstream patch
+    Backports may be exact, have a renamed subject, or only include part of the patch
+    """
+
+    kind = rand.choice(("exact", "renamed", "partial"))
+    subject = upstream.subject
+    filenames = upstream.affectedFilenames.split(" ")
+    diffs = upstream.commitDiffs
+    if kind == "renamed":
+        subject = f"UBUNTU: SAUCE: {make_sentence(rand, 3)} {subject.split(': ')[-1]}"
+    elif kind == "partial":
+        # Drop some lines, and the last file of multi-file patches
+        filenames = filenames[:-1] or filenames
+        lines = []
+        filename = None
+        for line in diffs.splitlines():
+            if line[0] not in "+-":
+                filename = line
+            if filename in filenames and (line[0] not in "+-" or rand.random() < 0.85):
+                lines.append(line)
+        diffs = "\n".join(lines)
+
+    # Downstream references to upstream commits are omitted, those are resolved exactly
+    return upstream._replace(
+        commitID=f"{rand.getrandbits(128):032x}{num:08x}",
+        subject=subject,
+        commitTime=upstream.commitTime + timedelta(days=rand.randrange(1, 90)),
+        affectedFilenames=" ".join(filenames),
+        commitDiffs=diffs,
+    )
+
+
+def make_corpus(upstream_count: int, downstream_count: int, seed: int = 0) -> Corpus:
+    """
+    Generate synthetic upstream and downstream corpora
+    Some upstream patches are backported downstream, the rest of downstream is unrelated patches
+    """
+
+    rand = random.Random(seed)
+    upstream = [make_upstream(rand, num) for num in range(upstream_count)]
+    backported = rand.sample(
+        upstream, min(downstream_count, int(upstream_count * BACKPORT_FRACTION))
+    )
+    downstream = [make_backport(rand, patch, num) for num, patch in enumerate(backported)]
+    downstream.extend(make_upstream(rand, num) for num in range(len(downstream), downstream_count))
+    rand.shuffle(downstream)
+
+    return Corpus(upstream, downstream)
+
+
+def record_corpus(path: Path, corpus: Corpus) -> None:
+    """Record a corpus to a SQLite snapshot"""
+
+    for name, patches in corpus._asdict().items():
+        cache = DiskCache(path, name)
+        try:
+            cache.delete_many(list(cache.keys()))
+            cache.set_many({f"{num:08d}": patch.to_json() for num, patch in enumerate(patches)})
+        finally:
+            cache.close()
+
+
+def replay_corpus(path: Path) -> Corpus:
+    """Load a corpus recorded with record_corpus()"""
+
+    patches = {}
+    for name in Corpus._fields:
+        cache = DiskCache(path, name)
+        try:
+            values = cache.get_many(cache.keys())
+        finally:
+            cache.close()
+        patches[name] = [PatchRecord.from_json(values[key]) for key in sorted(values)]
+
+    return Corpus(**patches)
+
+
+def load_corpus(
+    database: Path,
+    repo: Repo,
+    reference: str,
+    sections: Sequence[str],
+    since: Optional[str] = None,
+) -> Corpus:
+    """
+    Build a real corpus from a local comma SQLite database and repo
+    Upstream patches are the missing cherries for the reference, as when monitoring downstream
+    """
+
+    paths = repo.get_tracked_paths(sections)
+    missing_cherries = repo.get_missing_cherries(reference, paths, since=since)
+
+    engine = sqlalchemy.create_engine(f"sqlite:///{database}")
+    with Session(engine) as session:
+        upstream = [
+            PatchRecord(**{field: getattr(patch, field) for field in PATCH_DATA_FIELDS})
+            for patch in session.query(PatchData)
+            .options(undefer(PatchData.description), undefer(PatchData.commitDiffs))
+            .filter(PatchData.commitID.in_(missing_cherries))
+            .order_by(PatchData.commitTime)
+        ]
+    if not upstream:
+        return Corpus([], [])
+
+    downstream = repo.get_cached_patch_records(
+        reference, paths, since=upstream[0].commitTime.isoformat()
+    )
+    return Corpus(upstream, downstream)
+
+
+def match_exhaustive(corpus: Corpus, _jobs: int) -> List[Optional[str]]:
+    """Compare every pair of patches"""
+
+    return [
+        getattr(find_match(corpus.downstream, upstream), "commitID", None)
+        for upstream in corpus.upstream
+    ]
+
+
+def match_indexed(corpus: Corpus, _jobs: int) -> List[Optional[str]]:
+    """Only compare candidates selected by DownstreamIndex"""
+
+    index = DownstreamIndex(corpus.downstream)
+    return [getattr(index.find_match(upstream), "commitID", None) for upstream in corpus.upstream]
+
+
+def match_bounded(corpus: Corpus, _jobs: int) -> List[Optional[str]]:
+    """Only compare candidates selected by DownstreamIndex which may meet the threshold"""
+
+    index = DownstreamIndex(corpus.downstream)
+    bounds = ConfidenceBounds(corpus.upstream, corpus.downstream)
+    return [
+        getattr(index.find_match(upstream, bounds), "commitID", None)
+        for upstream in corpus.upstream
+    ]
+
+
+def match_parallel(corpus: Corpus, jobs: int) -> List[Optional[str]]:
+    """Match as downstream monitoring does, see match_patches()"""
+
+    results, _ = match_patches(corpus.upstream, corpus.downstream, jobs)
+    return [getattr(match, "commitID", None) for match, _ in results]
+
+
+IMPLEMENTATIONS: Dict[str, Callable[[Corpus, int], List[Optional[str]]]] = {
+    BASELINE: match_exhaustive,
+    "indexed": match_indexed,
+    "parallel": match_parallel,
+}
+if BATCH_AVAILABLE:
+    IMPLEMENTATIONS["bounded"] = match_bounded
+
+# Implementations which match in worker processes, their peak memory only covers this process
+PARENT_MEMORY_ONLY = {"parallel"}
+
+
+def run(func: Callable[[Corpus, int], List[Optional[str]]], corpus: Corpus, jobs: int) -> Result:
+    """
+    Match a corpus and measure wall time and peak memory
+
+    Tracing allocations slows Python code far more than native code, so the corpus is matched
+    twice, once for wall time and once with tracing for peak memory. Memory is only traced in
+    this process, so worker processes are not included, see PARENT_MEMORY_ONLY.
+    Caches are cleared before each pass, so no pass benefits from an earlier one.
+    """
+
+    get_filepaths.cache_clear()
+    start = time.perf_counter()
+    verdicts = func(corpus, jobs)
+    elapsed = time.perf_counter() - start
+
+    get_filepaths.cache_clear()
+    tracemalloc.start()
+    try:
+        func(corpus, jobs)
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return Result(verdicts, elapsed, peak_memory)
+
+
+def count_differences(
+    corpus: Corpus, verdicts: Sequence[Optional[str]], expected: Sequence[Optional[str]]
+) -> Tuple[int, int]:
+    """
+    Count upstream patches where verdicts differ
+    Returns patches with a different missing status and patches matched to a different commit
+    """
+
+    status = commits = 0
+    for upstream, verdict, other in zip(corpus.upstream, verdicts, expected):
+        if (verdict is None) != (other is None):
+            status += 1
+            print(f"  {upstream.commitID}: found {verdict}, expected {other}")
+        elif verdict != other:
+            commits += 1
+
+    return status, commits
+
+
+def main(args: Optional[Sequence[str]] = None):
+    """
+    Run benchmark and print results
+    """
+
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--upstream", type=int, default=100, help="Synthetic upstream patches")
+    parser.add_argument("--downstream", type=int, default=1000, help="Synthetic downstream patches")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for synthetic corpora")
+    parser.add_argument("--replay", type=Path, metavar="SNAPSHOT", help="Replay a recorded corpus")
+    parser.add_argument("--record", type=Path, metavar="SNAPSHOT", help="Record the corpus used")
+    parser.add_argument(
+        "--database", type=Path, help="Build a real corpus from this comma SQLite database"
+    )
+    parser.add_argument("--repo", default="linux", help="Name of repo under Repos directory")
+    parser.add_argument("--reference", help="Downstream reference for a real corpus")
+    parser.add_argument("--since", help="Limit upstream history for a real corpus")
+    parser.add_argument(
+        "--section",
+        action="append",
+        dest="sections",
+        help=f"MAINTAINERS section to track, may be repeated. Defaults to {DEFAULT_SECTIONS}",
+    )
+    parser.add_argument(
+        "--implementation",
+        action="append",
+        dest="implementations",
+        choices=IMPLEMENTATIONS,
+        help=f"Implementation to run, may be repeated. Defaults to all, compared to {BASELINE}",
+    )
+    parser.add_argument("-j", "--jobs", type=int, default=2, help="Processes for parallel")
+    options = parser.parse_args(args)
+
+    if options.replay:
+        if not options.replay.is_file():
+            sys.exit(f"Snapshot '{options.replay}' does not exist")
+        corpus = replay_corpus(options.replay)
+    elif options.database:
+        if options.reference is None:
+            parser.error("--reference is required with --database")
+        repo = Repo(options.repo, url="")
+        if not repo.exists:
+            sys.exit(f"Repo '{options.repo}' does not exist, run comma first to clone it")
+        corpus = load_corpus(
+            options.database,
+            repo,
+            options.reference,
+            options.sections or DEFAULT_SECTIONS,
+            options.since,
+        )
+    else:
+        corpus = make_corpus(options.upstream, options.downstream, options.seed)
+
+    if options.record:
+        record_corpus(options.record, corpus)
+
+    pairs = len(corpus.upstream) * len(corpus.downstream)
+    print(
+        f"{len(corpus.upstream)} upstream x {len(corpus.downstream)} downstream patches, "
+        f"{pairs} pairs"
+    )
+
+    baseline = None
+    for name in options.implementations or IMPLEMENTATIONS:
+        result = run(IMPLEMENTATIONS[name], corpus, options.jobs)
+        baseline = baseline or result
+        missing = result.verdicts.count(None)
+        peak = "parent peak" if name in PARENT_MEMORY_ONLY else "peak"
+        print(
+            f"{name:<12} {result.elapsed:8.3f}s {pairs / max(result.elapsed, 1e-9):12.0f} pairs/s "
+            f"{result.peak_memory / 2**20:8.1f} MiB {peak:<11} {missing:6d} missing"
+        )
+        if result is not baseline:
+            status, commits = count_differences(corpus, result.verdicts, baseline.verdicts)
+            print(f"{'':<12} {status} verdicts differ, {commits} matched to other commits")
+
+
+if __name__ == "__main__":
+    main()
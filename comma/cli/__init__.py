@@ -92,12 +92,16 @@ class Session:
 
         if options.upstream:
             LOGGER.info("Begin monitoring upstream")
-            Upstream(self.config, self.database, repo).process_commits(options.force_update)
+            Upstream(self.config, self.database, repo).process_commits(
+                options.force_update, options.batch_size, options.jobs
+            )
             LOGGER.info("Finishing monitoring upstream")
 
         if options.downstream:
             LOGGER.info("Begin monitoring downstream")
-            Downstream(self.config, self.database, repo).monitor()
+            Downstream(self.config, self.database, repo).monitor(
+                options.jobs, options.fetch_jobs, options.fetch_per_host, options.verify_matching
+            )
             LOGGER.info("Finishing monitoring downstream")
 
     def symbols(self, options):
@@ -181,10 +185,15 @@ def main(args: Optional[Sequence[str]] = None):
 
     try:
         # Get database object
-        database = DatabaseDriver(dry_run=options.dry_run, echo=options.verbose > 2)
+        database = DatabaseDriver(
+            dry_run=options.dry_run, echo=options.verbose > 2, in_memory=options.in_memory
+        )
 
         # Create session object and invoke subcommand
-        Session(config, database)(options)
+        try:
+            Session(config, database)(options)
+        finally:
+            database.close()
 
     except CommaError as e:
         sys.exit(f"ERROR: {e}")
@@ -37,6 +37,11 @@ def get_base_parsers():
         action="store_true",
         help="Do not connect to production database",
     )
+    parsers["database"].add_argument(
+        "--in-memory",
+        action="store_true",
+        help="With --dry-run, work on an in-memory copy of the local database, saved at exit",
+    )
 
     parsers["logging"].add_argument(
         "-v",
@@ -94,6 +99,40 @@ def get_run_parser():
         action="store_true",
         help="Force update to existing upstream patch records",
     )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=500,
+        metavar="COMMITS",
+        help="Number of upstream commits written to the database per transaction",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        metavar="N",
+        help="Number of processes used to parse commits",
+    )
+    parser.add_argument(
+        "--fetch-jobs",
+        type=int,
+        default=4,
+        metavar="N",
+        help="Maximum number of concurrent downstream fetches",
+    )
+    parser.add_argument(
+        "--fetch-per-host",
+        type=int,
+        default=2,
+        metavar="N",
+        help="Maximum number of concurrent downstream fetches from a single host",
+    )
+    parser.add_argument(
+        "--verify-matching",
+        action="store_true",
+        help="Check indexed downstream matching against exhaustive matching (slow)",
+    )
 
     return parser
 
@@ -245,6 +284,13 @@ def parse_args(args: Optional[Sequence[str]] = None):
         elif options.action == "delete" and options.name is None:
             parser.error("Name is required")
 
+    if options.in_memory and not options.dry_run:
+        parser.error("--in-memory requires --dry-run")
+
+    for name in ("batch_size", "jobs", "fetch_jobs", "fetch_per_host"):
+        if getattr(options, name, 1) < 1:
+            parser.error(f"--{name.replace('_', '-')} must be at least 1")
+
     # Configuration file was specified
     if options.config is not None:
         if not options.config.is_file():
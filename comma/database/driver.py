@@ -7,47 +7,131 @@ Provide a class for managing database connections and sessions
 
 import logging
 import os
+import sqlite3
 import struct
 import urllib
 import pyodbc
 from contextlib import contextmanager
-from typing import Any
+from typing import Any, Mapping, Sequence
 
 import sqlalchemy
 from sqlalchemy.engine.url import URL
 from azure.identity import DefaultAzureCredential
 
-from comma.database.model import Base, Distros, MonitoringSubjects
+from comma.database.migration import upgrade
+from comma.database.model import Base, Distros, MatchResults, MonitoringSubjects
 from comma.exceptions import CommaDatabaseError, CommaDataError
 
 
 LOGGER = logging.getLogger(__name__)
 
+# Rows sent per executemany call, bounds driver memory for rows with large text columns
+BULK_BATCH_SIZE = 1000
+
+# Local SQLite databases trade durability on power loss for speed, they can be regenerated
+SQLITE_FILE = "comma.db"
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "cache_size": -262144,  # Negative values are in KiB, 256 MiB
+    "mmap_size": 1073741824,  # 1 GiB
+    "temp_store": "MEMORY",
+}
+
 
 class DatabaseDriver:
     """
     Database driver managing connections
     """
 
-    def __init__(self, dry_run, echo=False):
+    def __init__(self, dry_run, echo=False, in_memory=False):
+        """
+        in_memory: Load the local SQLite database into memory, see close()
+        """
+
         # Enable INFO-level logging when program is logging debug
         # It's not ideal, because the messages are INFO level, but only enabled with debug
 
         # As defined in msodbcsql.h
         self.SQL_COPT_SS_ACCESS_TOKEN = 1256
-
-        if dry_run:
-            db_file = "comma.db"
-            LOGGER.info("Using local SQLite database at '%s'.", db_file)
-            engine = sqlalchemy.create_engine(f"sqlite:///{db_file}", echo=echo)
+        self.in_memory = in_memory
+
+        if dry_run and in_memory:
+            LOGGER.info("Using in-memory copy of local SQLite database at '%s'.", SQLITE_FILE)
+            engine = self.create_memory_engine(echo)
+        elif dry_run:
+            LOGGER.info("Using local SQLite database at '%s'.", SQLITE_FILE)
+            engine = self.create_sqlite_engine(echo)
         else:
             LOGGER.info("Connecting to remote database...")
             engine = self.create_engine()
 
+        self.engine = engine
         Base.metadata.bind = engine
         Base.metadata.create_all(engine)
+        upgrade(engine)
         self.session_factory = sqlalchemy.orm.sessionmaker(bind=engine)
 
+    @staticmethod
+    def create_sqlite_engine(echo=False) -> Any:
+        """
+        Create engine for the local SQLite database, tuned for throughput
+        """
+
+        engine = sqlalchemy.create_engine(f"sqlite:///{SQLITE_FILE}", echo=echo)
+
+        @sqlalchemy.event.listens_for(engine, "connect")
+        def set_pragmas(connection, _):
+            cursor = connection.cursor()
+            for pragma, value in SQLITE_PRAGMAS.items():
+                cursor.execute(f"PRAGMA {pragma} = {value}")
+            cursor.close()
+
+        return engine
+
+    @staticmethod
+    def create_memory_engine(echo=False) -> Any:
+        """
+        Create engine for an in-memory SQLite database, loaded from the local SQLite database
+        All sessions share a single connection, since each connection has its own database
+        """
+
+        engine = sqlalchemy.create_engine(
+            "sqlite://",
+            echo=echo,
+            poolclass=sqlalchemy.pool.StaticPool,
+            connect_args={"check_same_thread": False},
+        )
+
+        if os.path.exists(SQLITE_FILE):
+            connection = engine.raw_connection()
+            source = sqlite3.connect(SQLITE_FILE)
+            try:
+                source.backup(connection.connection)
+            finally:
+                source.close()
+                connection.close()
+
+        return engine
+
+    def close(self):
+        """
+        Release database connections
+        An in-memory database is first saved to the local SQLite database with the backup API
+        """
+
+        if self.in_memory:
+            LOGGER.info("Saving in-memory database to '%s'.", SQLITE_FILE)
+            connection = self.engine.raw_connection()
+            target = sqlite3.connect(SQLITE_FILE)
+            try:
+                connection.connection.backup(target)
+            finally:
+                target.close()
+                connection.close()
+
+        self.engine.dispose()
+
     def get_driver_name(self) -> str:
         driver_names = [x for x in pyodbc.drivers() if x.endswith(" for SQL Server")]
         LOGGER.debug("Available ODBC drivers: %s", driver_names)
@@ -89,6 +173,7 @@ class DatabaseDriver:
                     query={"driver": driver},
                 ),
                 pool_recycle=300,
+                fast_executemany=True,
             )
         except Exception as e:
             raise RuntimeError(
@@ -110,6 +195,7 @@ class DatabaseDriver:
                 URL("mssql+pyodbc", query=query),
                 connect_args=connect_args,
                 pool_recycle=300,
+                fast_executemany=True,
             )
         except Exception as e:
             raise RuntimeError("Failed to create engine with Azure AD token") from e
@@ -131,6 +217,72 @@ class DatabaseDriver:
         finally:
             session.close()
 
+    def bulk_write(
+        self, session: sqlalchemy.orm.Session, statement, rows: Sequence[Mapping[str, Any]]
+    ) -> int:
+        """
+        Execute a statement for many rows, in batches of BULK_BATCH_SIZE
+
+        Batches are sent with executemany. MSSQL engines use pyodbc's fast_executemany, so each
+        batch is a single round trip rather than one per row. Returns the number of rows.
+        """
+
+        for start in range(0, len(rows), BULK_BATCH_SIZE):
+            end = start + BULK_BATCH_SIZE
+            session.execute(statement, rows[start:end])
+
+        return len(rows)
+
+    def bulk_insert(
+        self, session: sqlalchemy.orm.Session, model, rows: Sequence[Mapping[str, Any]]
+    ) -> int:
+        """
+        Insert rows of column values into the table for model, see bulk_write()
+        """
+
+        return self.bulk_write(session, model.__table__.insert(), rows) if rows else 0
+
+    def bulk_update(
+        self,
+        session: sqlalchemy.orm.Session,
+        model,
+        key: str,
+        rows: Sequence[Mapping[str, Any]],
+    ) -> int:
+        """
+        Update rows in the table for model, see bulk_write()
+
+        Each row is matched on the key column, given as "_<key>" so it isn't updated,
+        and the remaining values are set.
+        """
+
+        if not rows:
+            return 0
+
+        table = model.__table__
+        return self.bulk_write(
+            session, table.update().where(table.c[key] == sqlalchemy.bindparam(f"_{key}")), rows
+        )
+
+    def bulk_delete(
+        self, session: sqlalchemy.orm.Session, model, rows: Sequence[Mapping[str, Any]]
+    ) -> int:
+        """
+        Delete rows from the table for model matching all given column values, see bulk_write()
+        """
+
+        if not rows:
+            return 0
+
+        table = model.__table__
+        return self.bulk_write(
+            session,
+            table.delete().where(
+                *(table.c[column] == sqlalchemy.bindparam(f"_{column}") for column in rows[0])
+            ),
+            [{f"_{column}": value for column, value in row.items()} for row in rows],
+        )
+
     def update_revisions_for_distro(self, distro_id, revs):
         """
         Updates the database with the given revisions
@@ -145,6 +297,9 @@ class DatabaseDriver:
             )
             for subject in revs_to_delete:
                 LOGGER.info("For distro %s, deleting revision: %s", distro_id, subject.revision)
+                session.query(MatchResults).filter_by(
+                    monitoringSubjectID=subject.monitoringSubjectID
+                ).delete(synchronize_session=False)
 
             # This is a bulk delete and we close the session immediately after.
             revs_to_delete.delete(synchronize_session=False)
@@ -231,6 +386,9 @@ class DatabaseDriver:
                 LOGGER.info(
                     "Deleting downstream target: remote=%s revision=%s", name, target.revision
                 )
+                session.query(MatchResults).filter_by(
+                    monitoringSubjectID=target.monitoringSubjectID
+                ).delete(synchronize_session=False)
             targets.delete(synchronize_session=False)
 
             LOGGER.info("Deleting remote: %s", name)
@@ -243,9 +401,15 @@ class DatabaseDriver:
 
         with self.get_session() as session:
             LOGGER.info("Deleting downstream target: remote=%s revision=%s", name, revision)
-            session.query(MonitoringSubjects).filter_by(distroID=name).filter_by(
+            targets = session.query(MonitoringSubjects).filter_by(distroID=name).filter_by(
                 revision=revision
+            )
+            session.query(MatchResults).filter(
+                MatchResults.monitoringSubjectID.in_(
+                    targets.with_entities(MonitoringSubjects.monitoringSubjectID)
+                )
             ).delete(synchronize_session=False)
+            targets.delete(synchronize_session=False)
 
     def get_downstream_repos(self):
         """
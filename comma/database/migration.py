@@ -0,0 +1,169 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+"""
+Versioned schema migrations for existing databases
+
+Base.metadata.create_all() only creates missing tables, so changes to existing tables,
+such as new indexes, are applied here. Each migration runs once and is recorded in the
+SchemaVersions table. Migrations are idempotent, so they can also run against tables that
+were just created with the current schema.
+"""
+
+import logging
+from datetime import datetime
+from typing import Callable, NamedTuple
+
+import sqlalchemy
+from sqlalchemy.engine import Connection, Engine
+
+from comma.database.model import (
+    MonitoringSubjectsMissingPatches,
+    PatchData,
+    PatchFiles,
+    SchemaVersions,
+)
+from comma.exceptions import CommaDataError
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Migration(NamedTuple):
+    """Schema change applied to existing databases"""
+
+    version: int
+    description: str
+    upgrade: Callable[[Connection], None]
+
+
+def create_index(connection: Connection, table: sqlalchemy.Table, name: str) -> None:
+    """
+    Create an index declared in the model, unless it already exists
+    """
+
+    if name in {index["name"] for index in sqlalchemy.inspect(connection).get_indexes(table.name)}:
+        return
+
+    LOGGER.info("Creating index %s on %s", name, table.name)
+    next(index for index in table.indexes if index.name == name).create(connection)
+
+
+def size_column(connection: Connection, table: sqlalchemy.Table, name: str) -> None:
+    """
+    Resize an unbounded string column to the length declared in the model
+    MSSQL can't index VARCHAR(MAX) columns, other dialects are unaffected
+    """
+
+    if connection.dialect.name != "mssql":
+        return
+
+    existing = next(
+        column
+        for column in sqlalchemy.inspect(connection).get_columns(table.name)
+        if column["name"] == name
+    )
+    length = table.c[name].type.length
+    if existing["type"].length == length:
+        return
+
+    # Keep the existing type family (VARCHAR or NVARCHAR) and nullability
+    type_name = existing["type"].__visit_name__.upper()
+    null = "NULL" if existing["nullable"] else "NOT NULL"
+    LOGGER.info("Resizing column %s.%s to %s(%d)", table.name, name, type_name, length)
+    connection.execute(
+        sqlalchemy.text(
+            f"ALTER TABLE [{table.name}] ALTER COLUMN [{name}] {type_name}({length}) {null}"
+        )
+    )
+
+
+def index_patch_data(connection: Connection) -> None:
+    """
+    Index commit IDs, which are looked up for every ingested commit, and commit times,
+    which are used for ordering and since filters
+    """
+
+    table = PatchData.__table__
+
+    duplicates = connection.execute(
+        sqlalchemy.select(table.c.commitID)
+        .group_by(table.c.commitID)
+        .having(sqlalchemy.func.count() > 1)
+    ).all()
+    if duplicates:
+        raise CommaDataError(
+            f"Unable to index {table.name}.commitID, {len(duplicates)} commits are duplicated, "
+            f"for example {duplicates[0][0]}. Remove duplicate rows and run again"
+        )
+
+    size_column(connection, table, "commitID")
+    create_index(connection, table, "ix_PatchData_commitID")
+    create_index(connection, table, "ix_PatchData_commitTime")
+
+
+def index_missing_patches(connection: Connection) -> None:
+    """
+    Index patch IDs for missing patches, which are queried per patch when reporting
+    """
+
+    create_index(
+        connection,
+        MonitoringSubjectsMissingPatches.__table__,
+        "ix_MonitoringSubjectsMissingPatches_patchID",
+    )
+
+
+def backfill_patch_files(connection: Connection) -> None:
+    """
+    Populate PatchFiles from PatchData.affectedFilenames for patches without files
+    """
+
+    table = PatchFiles.__table__
+    patches = connection.execute(
+        sqlalchemy.select(PatchData.patchID, PatchData.affectedFilenames).where(
+            ~sqlalchemy.exists().where(table.c.patchID == PatchData.patchID)
+        )
+    ).all()
+    LOGGER.info("Adding affected files for %d patches", len(patches))
+
+    rows = [
+        row
+        for patch_id, affected_filenames in patches
+        for row in PatchFiles.get_legacy_rows(patch_id, affected_filenames or "")
+    ]
+    # Keep statements a reasonable size
+    for start in range(0, len(rows), 1000):
+        end = start + 1000
+        connection.execute(table.insert(), rows[start:end])
+
+
+MIGRATIONS = (
+    Migration(1, "Index PatchData commit IDs and commit times", index_patch_data),
+    Migration(2, "Index MonitoringSubjectsMissingPatches patch IDs", index_missing_patches),
+    Migration(3, "Populate PatchFiles from PatchData", backfill_patch_files),
+)
+
+
+def upgrade(engine: Engine) -> None:
+    """
+    Apply migrations which haven't been applied yet
+    Each migration is applied and recorded in its own transaction
+    """
+
+    with engine.connect() as connection:
+        applied = set(connection.execute(sqlalchemy.select(SchemaVersions.version)).scalars())
+
+    for migration in MIGRATIONS:
+        if migration.version in applied:
+            continue
+
+        LOGGER.info("Applying schema migration %d: %s", migration.version, migration.description)
+        with engine.begin() as connection:
+            migration.upgrade(connection)
+            connection.execute(
+                sqlalchemy.insert(SchemaVersions).values(
+                    version=migration.version,
+                    description=migration.description,
+                    appliedTime=datetime.utcnow(),
+                )
+            )
@@ -4,19 +4,20 @@
 ORM models for database objects
 """
 
+import os
 from datetime import datetime
+from typing import Dict, Iterable, List
 
 import git
-from sqlalchemy import Column, DateTime, ForeignKey, Integer, String
+from sqlalchemy import Column, DateTime, Float, ForeignKey, Integer, String
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import deferred, relationship
 
 from comma.util import format_diffs
+from comma.util.history import PatchRecord, parse_message
 from comma.util.tracking import get_filenames
 
 
-IGNORED_IN_CMSG = "reported-by:", "signed-off-by:", "reviewed-by:", "acked-by:", "cc:"
-
 Base = declarative_base()
 
 # pylint: disable=invalid-name,too-few-public-methods
@@ -30,16 +31,17 @@ class PatchData(Base):
     __tablename__ = "PatchData"
     patchID = Column(Integer, primary_key=True)
     subject = Column(String)
-    commitID = Column(String)
-    description = Column(String)
+    commitID = Column(String(40), index=True, unique=True)
+    # Large text columns are only loaded when accessed or explicitly requested with undefer()
+    description = deferred(Column(String))
     author = Column(String)
     authorEmail = Column(String)
     authorTime = Column(DateTime())
     # TODO (Issue 40): What about committer and their email?
-    commitTime = Column(DateTime())
-    # TODO (Issue 40): Should we have a filenames table?
+    commitTime = Column(DateTime(), index=True)
+    # Space-separated, see PatchFiles for the normalized form
     affectedFilenames = Column(String)
-    commitDiffs = Column(String)
+    commitDiffs = deferred(Column(String))
     # TODO (Issue 40): Should we have a symbols table?
     symbols = Column(String)
     # TODO (Issue 40): Should this reference a patchID?
@@ -48,6 +50,8 @@ class PatchData(Base):
     metaData = relationship("PatchDataMeta", uselist=False, back_populates="patch")
     # TODO (Issue 40): If this 1-1, why isn't `status` just a column on `PatchData`?
     upstreamStatus = relationship("UpstreamPatchStatuses", uselist=False, back_populates="patch")
+    hashes = relationship("PatchDataHashes", uselist=False, back_populates="patch")
+    files = relationship("PatchFiles", back_populates="patch", lazy="dynamic")
     monitoringSubject = relationship(
         "MonitoringSubjectsMissingPatches",
         back_populates="patches",
@@ -60,39 +64,32 @@ class PatchData(Base):
         Create patch object from a commit object
         """
 
-        patch = cls(
-            commitID=commit.hexsha,
-            author=commit.author.name,
-            authorEmail=commit.author.email,
-            authorTime=datetime.utcfromtimestamp(commit.authored_date),
-            commitTime=datetime.utcfromtimestamp(commit.committed_date),
+        subject, description, fixed_patches = parse_message(commit.message)
+        filenames = get_filenames(commit)
+
+        return cls.from_record(
+            PatchRecord(
+                commitID=commit.hexsha,
+                subject=subject,
+                description=description,
+                author=commit.author.name,
+                authorEmail=commit.author.email,
+                authorTime=datetime.utcfromtimestamp(commit.authored_date),
+                commitTime=datetime.utcfromtimestamp(commit.committed_date),
+                affectedFilenames=" ".join(filenames),
+                commitDiffs=format_diffs(commit, paths),
+                fixedPatches=fixed_patches,
+                affectedPaths=tuple(filenames),
+            )
         )
 
-        description = []
-        fixed_patches = []
-        for num, line in enumerate(commit.message.splitlines()):
-            line = line.strip()  # pylint: disable=redefined-loop-name
-            if not num:
-                patch.subject = line
-                continue
-
-            if line.lower().startswith(IGNORED_IN_CMSG):
-                continue
-
-            description.append(line)
-
-            # Check if this patch fixes other patches
-            if line.lower().startswith("fixes:"):
-                words = line.split(" ")
-                if len(words) > 1:
-                    fixed_patches.append(words[1])
-
-        patch.description = "\n".join(description)
-        patch.fixedPatches = " ".join(fixed_patches)  # e.g. "SHA1 SHA2 SHA3"
-        patch.affectedFilenames = " ".join(get_filenames(commit))
-        patch.commitDiffs = format_diffs(commit, paths)
+    @classmethod
+    def from_record(cls, record: PatchRecord) -> "PatchData":
+        """
+        Create patch object from a patch record
+        """
 
-        return patch
+        return cls(**record.get_columns())
 
 
 class PatchDataMeta(Base):
@@ -117,6 +114,65 @@ class UpstreamPatchStatuses(Base):
     patch = relationship("PatchData", uselist=False, back_populates="upstreamStatus")
 
 
+class PatchDataHashes(Base):
+    """
+    Holds a digest of the fields derived from a patch's commit
+    """
+
+    __tablename__ = "PatchDataHashes"
+    patchID = Column(Integer, ForeignKey("PatchData.patchID"), primary_key=True)
+    # See comma.util.history.PatchRecord.get_content_hash
+    contentHash = Column(String(40))
+    # Digest of the tracked paths used to generate commitDiffs
+    pathsVersion = Column(String(40))
+    patch = relationship("PatchData", uselist=False, back_populates="hashes")
+
+
+class PatchFiles(Base):
+    """
+    Files affected by a patch, one row per path for indexed lookups
+    """
+
+    __tablename__ = "PatchFiles"
+    patchID = Column(Integer, ForeignKey("PatchData.patchID"), primary_key=True)
+    path = Column(String(512), primary_key=True, index=True)
+    basename = Column(String(255), index=True)
+    patch = relationship("PatchData", back_populates="files")
+
+    @staticmethod
+    def get_rows(patch_id: int, paths: Iterable[str]) -> List[Dict]:
+        """
+        Get column values for the files in a list of affected file names
+        """
+
+        return [
+            {"patchID": patch_id, "path": path, "basename": os.path.basename(path)}
+            for path in sorted(set(paths) - {""})
+        ]
+
+    @classmethod
+    def get_legacy_rows(cls, patch_id: int, affected_filenames: str) -> List[Dict]:
+        """
+        Get column values for the files in a space-separated list of affected file names
+        Only used to backfill existing patches, paths containing spaces are split
+        """
+
+        return cls.get_rows(patch_id, affected_filenames.split(" "))
+
+
+class UpstreamWatermarks(Base):
+    """
+    Last fully processed upstream commit for a reference
+    """
+
+    __tablename__ = "UpstreamWatermarks"
+    reference = Column(String(255), primary_key=True)
+    # Digest of the tracked paths and upstream since used when processing,
+    # see comma.upstream.get_watermark_version
+    pathsVersion = Column(String(40))
+    commitID = Column(String(40))
+
+
 class Distros(Base):
     """
     Downstream distro and URL for downstream repo
@@ -164,5 +220,42 @@ class MonitoringSubjectsMissingPatches(Base):
         # (as referenced by the foreign key above), that this is deleted too.
         cascade="all, delete-orphan",
     )
-    patchID = Column(Integer, ForeignKey("PatchData.patchID"), primary_key=True)
+    # Indexed separately, since it isn't the leading primary key column
+    patchID = Column(Integer, ForeignKey("PatchData.patchID"), primary_key=True, index=True)
     patches = relationship("PatchData", back_populates="monitoringSubject")
+
+
+class MatchResults(Base):
+    """
+    Result of matching an upstream patch against a monitoring subject's downstream patches
+    Used to skip matching when nothing the result depends on has changed
+    """
+
+    __tablename__ = "MatchResults"
+    monitoringSubjectID = Column(
+        Integer, ForeignKey("MonitoringSubjects.monitoringSubjectID"), primary_key=True
+    )
+    patchID = Column(Integer, ForeignKey("PatchData.patchID"), primary_key=True)
+    # Matching downstream commit, None when the patch is missing
+    downstreamCommitID = Column(String(40))
+    # See comma.downstream.matcher.Match
+    matchMethod = Column(String(16))
+    score = Column(Float)
+    # See comma.downstream.matcher.get_matcher_version
+    matcherVersion = Column(String(40))
+    # See PatchDataHashes.contentHash
+    contentHash = Column(String(40))
+    # Downstream commit and oldest commit time the patch was matched against
+    downstreamTip = Column(String(40))
+    windowStart = Column(DateTime)
+
+
+class SchemaVersions(Base):
+    """
+    Schema migrations applied to the database, see comma.database.migration
+    """
+
+    __tablename__ = "SchemaVersions"
+    version = Column(Integer, primary_key=True, autoincrement=False)
+    description = Column(String(255))
+    appliedTime = Column(DateTime)
@@ -5,21 +5,40 @@ Operations for downstream targets
 """
 
 import logging
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
 
-import git
+from sqlalchemy.orm import undefer
 
 from comma.database.model import (
     Distros,
+    MatchResults,
     MonitoringSubjects,
     MonitoringSubjectsMissingPatches,
     PatchData,
+    PatchDataHashes,
 )
-from comma.downstream.matcher import patch_matches
+from comma.downstream.matcher import ReferenceIndex, get_matcher_version, match_patches
+from comma.util.history import PATCH_DATA_FIELDS, PatchRecord
+from comma.util.tracking import Repo, get_paths_version
 
 
 LOGGER = logging.getLogger(__name__.split(".", 1)[0])
 
 
+def get_host(url: str) -> str:
+    """
+    Get host for a remote URL, including scp-like syntax (user@host:path)
+    """
+
+    if host := urlparse(url).hostname:
+        return host
+
+    return url.split("@", 1)[-1].split(":", 1)[0]
+
+
 class Downstream:
     """
     Parent object for downstream operations
@@ -30,26 +49,61 @@ class Downstream:
         self.database = database
         self.repo = repo
 
-    def monitor(self):
+    def monitor(self, jobs=1, fetch_jobs=1, fetch_per_host=1, verify_matching=False):
         """
         Cycle through downstream remotes and search for missing commits
+        Downstream commits are parsed by jobs processes
+        When verify_matching is set, indexed matching is checked against exhaustive matching
+
+        Distros sharing a repository URL share a single remote, and all refs needed from
+        a remote are fetched together. Only subjects whose refs can't be fetched are skipped.
+        Remotes are fetched concurrently by up to fetch_jobs threads, with at most
+        fetch_per_host fetches to a single host. Shallow fetches are serialized, since they
+        lock the repository's shallow file. Subjects are monitored once all fetches complete.
+
+        Remotes are fetched into the upstream repo. Fetching shallow since downstream_since
+        makes it a shallow repo, and git ignores commit-graphs in shallow repos.
         """
 
         repo = self.repo
+        distro_remotes = {}
+        remote_hosts = {}
 
         # Add repos as a remote if not already added. Only if used in a downstream target
         with self.database.get_session() as session:
-            for distro_id, url in (
+            distro_urls = (
                 session.query(Distros.distroID, Distros.repoLink)
                 .select_from(MonitoringSubjects)
                 .join(MonitoringSubjects.distro)
                 .distinct()
+                .order_by(Distros.distroID)
                 .all()
-            ):
-                # Skip Debian for now
-                if distro_id not in self.repo.remotes and not distro_id.startswith("Debian"):
+            )
+
+        # Reuse any existing remote for a URL, preferring a remote named for a distro
+        distro_ids = {distro_id for distro_id, _ in distro_urls}
+        url_remotes = {}
+        for remote in sorted(repo.remotes, key=lambda remote: remote.name not in distro_ids):
+            for url in remote.urls:
+                url_remotes.setdefault(url, remote.name)
+
+        for distro_id, url in distro_urls:
+            # Skip Debian for now
+            if distro_id.startswith("Debian"):
+                continue
+
+            if url not in url_remotes:
+                if distro_id not in repo.remotes:
                     LOGGER.debug("Adding remote %s from %s", distro_id, url)
                     repo.create_remote(distro_id, url=url)
+                url_remotes[url] = distro_id
+
+            distro_remotes[distro_id] = url_remotes[url]
+            remote_hosts[url_remotes[url]] = get_host(url)
+
+        host_limits = {
+            host: threading.BoundedSemaphore(fetch_per_host) for host in set(remote_hosts.values())
+        }
 
         with self.database.get_session() as session:
             subjects = session.query(MonitoringSubjects).all()
@@ -58,6 +112,8 @@ class Downstream:
             if not total:
                 LOGGER.warning("No downstream targets defined")
 
+            # Group subjects by remote
+            remote_subjects = {}
             for num, subject in enumerate(subjects, 1):
                 if subject.distroID.startswith("Debian"):
                     # TODO (Issue 51): Don't skip Debian
@@ -72,19 +128,37 @@ class Downstream:
                     local_ref = f"{subject.distroID}/{subject.revision}"
                     remote_ref = subject.revision
 
-                LOGGER.info(
-                    "(%d of %d) Fetching remote ref %s from remote %s",
-                    num,
-                    total,
-                    remote_ref,
-                    subject.distroID,
+                remote_subjects.setdefault(distro_remotes[subject.distroID], []).append(
+                    (num, subject, local_ref, remote_ref)
                 )
-                try:
-                    repo.fetch_remote_ref(
-                        subject.distroID, local_ref, remote_ref, since=self.config.downstream_since
+
+            with ThreadPoolExecutor(max_workers=fetch_jobs) as executor:
+                fetches = [
+                    executor.submit(
+                        self.fetch_remote,
+                        host_limits[remote_hosts[remote]],
+                        remote,
+                        {local_ref: remote_ref for _, _, local_ref, remote_ref in items},
                     )
-                except git.GitCommandError as e:
-                    LOGGER.error("Failed to fetch remote ref %s: %s", remote_ref, e)
+                    for remote, items in remote_subjects.items()
+                ]
+
+            errors = {}
+            for future in fetches:
+                errors.update(future.result())
+
+            # Add fetched commits to the commit-graph before their history is queried
+            if not repo.is_shallow:
+                repo.write_commit_graph()
+
+            # Parsing and matching fork worker processes, so they only start once fetch
+            # threads have finished, since forking copies locks held by other threads
+            for num, subject, local_ref, remote_ref in sorted(
+                (item for items in remote_subjects.values() for item in items),
+                key=lambda item: item[0],
+            ):
+                if local_ref in errors:
+                    LOGGER.error("Failed to fetch remote ref %s: %s", remote_ref, errors[local_ref])
                     LOGGER.info("Skipping %s", subject.distroID)
                     continue
 
@@ -95,14 +169,41 @@ class Downstream:
                     subject.distroID,
                     remote_ref,
                 )
-                self.monitor_subject(subject, local_ref)
+                self.monitor_subject(subject, local_ref, jobs, verify_matching)
 
-    def monitor_subject(self, monitoring_subject, reference: str):
+        # Drop cached downstream commits which are no longer reachable from monitored refs
+        repo.evict_patch_records(
+            (local_ref for items in remote_subjects.values() for _, _, local_ref, _ in items),
+            repo.get_tracked_paths(self.config.upstream.sections),
+        )
+
+    def fetch_remote(self, host_limit, remote, refs):
+        """
+        Fetch remote refs for monitoring subjects, run in a fetch thread
+
+        host_limit: Semaphore limiting concurrent fetches to the remote's host
+        refs: Mapping of local reference names to remote reference names
+        Returns errors for local references which couldn't be fetched
+        """
+
+        with host_limit:
+            LOGGER.info("Fetching remote refs %s from remote %s", ", ".join(refs.values()), remote)
+            # GitPython objects aren't thread-safe, so each fetch uses its own repo object
+            repo = Repo(self.repo.name, self.repo.url, self.repo.default_ref)
+            try:
+                return repo.fetch_remote_refs(remote, refs, since=self.config.downstream_since)
+            finally:
+                # Stop persistent git cat-file processes started by the repo object
+                repo.obj.close()
+
+    def monitor_subject(self, monitoring_subject, reference: str, jobs=1, verify_matching=False):
         """
         Update the missing patches in the database for this monitoring_subject
 
         monitoring_subject: The MonitoringSubject we are updating
         reference: Git reference to monitor
+        jobs: Number of processes used to parse downstream commits
+        verify_matching: Check indexed matching against exhaustive matching
         """
 
         missing_cherries = self.repo.get_missing_cherries(
@@ -113,54 +214,66 @@ class Downstream:
         LOGGER.debug("Found %d missing patches through cherry-pick.", len(missing_cherries))
 
         # Run extra checks on these missing commits
-        missing_patch_ids = self.get_missing_patch_ids(missing_cherries, reference)
+        missing_patch_ids = self.get_missing_patch_ids(
+            missing_cherries,
+            reference,
+            jobs,
+            verify_matching,
+            monitoring_subject.monitoringSubjectID,
+        )
         LOGGER.info("Identified %d missing patches", len(missing_patch_ids))
 
-        # Delete patches that are no longer missing.
-        # NOTE: We do this in separate sessions in order to cleanly expire their objects and commit
-        # the changes to the database. There is surely another way to do this, but it works.
+        # Reconcile stored missing patches in a single transaction with a fixed number of queries
         subject_id = monitoring_subject.monitoringSubjectID
         with self.database.get_session() as session:
-            patches = session.query(MonitoringSubjectsMissingPatches).filter_by(
-                monitoringSubjectID=subject_id
+            stored = {
+                patch_id
+                for (patch_id,) in session.query(
+                    MonitoringSubjectsMissingPatches.patchID
+                ).filter_by(monitoringSubjectID=subject_id)
+            }
+            missing = set(missing_patch_ids)
+
+            patches_to_delete = stored - missing
+            LOGGER.info("Deleting %d patches that are now present.", len(patches_to_delete))
+            self.database.bulk_delete(
+                session,
+                MonitoringSubjectsMissingPatches,
+                [
+                    {"monitoringSubjectID": subject_id, "patchID": patch_id}
+                    for patch_id in sorted(patches_to_delete)
+                ],
             )
-            # Delete patches that are no longer missing: the patchID is
-            # NOT IN the latest set of missing patchIDs.
-            patches_to_delete = patches.filter(
-                ~MonitoringSubjectsMissingPatches.patchID.in_(missing_patch_ids)
-            )
-            LOGGER.info("Deleting %d patches that are now present.", patches_to_delete.count())
-            # This is a bulk delete and we close the session immediately after.
-            patches_to_delete.delete(synchronize_session=False)
 
-        # Add patches which are newly missing.
-        with self.database.get_session() as session:
-            patches = session.query(MonitoringSubjectsMissingPatches).filter_by(
-                monitoringSubjectID=subject_id
+            patches_to_add = missing - stored
+            LOGGER.info("Adding %d patches that are now missing.", len(patches_to_add))
+            self.database.bulk_insert(
+                session,
+                MonitoringSubjectsMissingPatches,
+                [
+                    {"monitoringSubjectID": subject_id, "patchID": patch_id}
+                    for patch_id in sorted(patches_to_add)
+                ],
             )
-            new_missing_patches = 0
-            for patch_id in missing_patch_ids:
-                # Only add if it doesn't already exist. We're dealing with patches on the scale
-                # of 100, so the number of queries and inserts here doesn't matter.
-                if patches.filter_by(patchID=patch_id).first() is None:
-                    new_missing_patches += 1
-                    session.add(
-                        MonitoringSubjectsMissingPatches(
-                            monitoringSubjectID=subject_id, patchID=patch_id
-                        )
-                    )
-            LOGGER.info("Adding %d patches that are now missing.", new_missing_patches)
 
-    def get_missing_patch_ids(self, missing_cherries, reference):
+    def get_missing_patch_ids(
+        self, missing_cherries, reference, jobs=1, verify_matching=False, subject_id=None
+    ):
         """
         Attempt to determine which patches are missing from a list of missing cherries
+        Patches referenced by downstream commits are found exactly, the rest are only compared
+        against candidates selected by DownstreamIndex
+        Match results are stored for subject_id, see match_leftovers()
         """
 
         paths = self.repo.get_tracked_paths(self.config.upstream.sections)
 
         with self.database.get_session() as session:
+            # The description is needed for every comparison, diffs are only loaded for patches
+            # which are matched, see match_leftovers()
             patches = (
                 session.query(PatchData)
+                .options(undefer(PatchData.description))
                 .filter(PatchData.commitID.in_(missing_cherries))
                 .order_by(PatchData.commitTime)
                 .all()
@@ -169,30 +282,197 @@ class Downstream:
                 return []
 
             # We only want to check downstream patches as old as the oldest upstream missing patch
-            earliest_commit_date = min(patch.commitTime for patch in patches).isoformat()
+            window_start = min(patch.commitTime for patch in patches)
+            earliest_commit_date = window_start.isoformat()
             LOGGER.debug("Processing commits since %s", earliest_commit_date)
 
             # Get the downstream commits for this revision (these are distinct from upstream because
             # they have been cherry-picked). This is slow but necessary!
 
             LOGGER.info("Determining downstream commits from tracked files")
-            # We use `--min-parents=1 --max-parents=1` to avoid both merges and graft commits
-            downstream_patches = tuple(
-                PatchData.create(commit, paths)
-                for commit in self.repo.iter_commits(
-                    rev=reference,
-                    paths=paths,
-                    min_parents=1,
-                    max_parents=1,
-                    since=earliest_commit_date,
-                )
+            downstream_patches = self.repo.get_cached_patch_records(
+                reference, paths, since=earliest_commit_date, jobs=jobs
             )
 
-            # Double check the missing cherries using our fuzzy algorithm.
-            LOGGER.info("Starting confidence matching for %d upstream patches...", len(patches))
-            missing_patches = [
-                p.patchID for p in patches if not patch_matches(downstream_patches, p)
-            ]
+            references = ReferenceIndex(downstream_patches)
+
+            # Resolve patches referenced by downstream messages exactly
+            # Patches with the same patch ID were already excluded by get_missing_cherries()
+            leftovers = [patch for patch in patches if references.find(patch) is None]
+            LOGGER.info("Found %d patches by upstream reference", len(patches) - len(leftovers))
+
+            # Double check the remaining missing cherries using our fuzzy algorithm.
+            # Stored results are reused when nothing they depend on has changed
+            content_hashes = dict(
+                session.query(PatchDataHashes.patchID, PatchDataHashes.contentHash)
+                .join(PatchDataHashes.patch)
+                .filter(PatchData.commitID.in_(missing_cherries))
+                .all()
+            )
+            stored = {
+                row.patchID: row
+                for row in session.query(MatchResults).filter_by(monitoringSubjectID=subject_id)
+            }
+            state = {
+                "tip": self.repo.obj.commit(reference).hexsha,
+                "window_start": window_start,
+                "version": get_matcher_version(get_paths_version(paths)),
+            }
+
+            leftover_ids = {patch.patchID for patch in leftovers}
+            evaluated, missing_patches, mismatches = self.match_leftovers(
+                session,
+                leftovers,
+                downstream_patches,
+                content_hashes,
+                stored,
+                state,
+                jobs,
+                verify_matching,
+            )
+
+            # Store new results, dropping results for patches which no longer need matching
+            for patch_id, row in stored.items():
+                if patch_id not in leftover_ids:
+                    session.delete(row)
+            for patch_id, match in evaluated.items():
+                row = stored.get(patch_id) or MatchResults(
+                    monitoringSubjectID=subject_id, patchID=patch_id
+                )
+                row.downstreamCommitID = getattr(match, "commitID", None)
+                row.matchMethod = getattr(match, "method", None)
+                row.score = getattr(match, "score", None)
+                row.matcherVersion = state["version"]
+                row.contentHash = content_hashes.get(patch_id)
+                row.downstreamTip = state["tip"]
+                row.windowStart = state["window_start"]
+                session.add(row)
+
+            if verify_matching:
+                LOGGER.info(
+                    "Verified indexed matching for %d upstream patches, %d differed",
+                    len(leftovers),
+                    mismatches,
+                )
 
         return missing_patches
 
+    def match_leftovers(
+        self,
+        session,
+        patches,
+        downstream_patches,
+        content_hashes,
+        stored,
+        state,
+        jobs=1,
+        verify=False,
+    ):
+        """
+        Match upstream patches against downstream patches, reusing stored results when possible
+
+        session: Session patches were loaded in, used to load diffs for patches being matched
+        content_hashes: Mapping of patch IDs to current content hashes
+        stored: Mapping of patch IDs to stored MatchResults rows for this subject
+        state: Current downstream tip, start of the downstream window, and matcher version
+
+        A stored match is reused while its downstream commit is still present. A stored miss is
+        reused when the downstream tip is unchanged, and is only checked against new downstream
+        commits when the old tip is an ancestor of the current one. Anything else, including
+        results for a different matcher version or patch content, is matched in full.
+
+        Returns a mapping of patch IDs to new results, the IDs of missing patches, and the
+        number of results which differed from exhaustive matching when verify is set
+        """
+
+        downstream_ids = {downstream.commitID for downstream in downstream_patches}
+        missing = []
+        full = []
+        incremental = {}
+        for patch in patches:
+            row = stored.get(patch.patchID)
+            if (
+                verify
+                or row is None
+                or row.matcherVersion != state["version"]
+                or row.contentHash != content_hashes.get(patch.patchID)
+            ):
+                full.append(patch)
+            elif row.downstreamCommitID is not None:
+                if row.downstreamCommitID in downstream_ids:
+                    continue
+                full.append(patch)
+            elif row.windowStart is None or row.windowStart > state["window_start"]:
+                full.append(patch)
+            elif row.downstreamTip == state["tip"]:
+                missing.append(patch.patchID)
+            else:
+                incremental.setdefault(row.downstreamTip, []).append(patch)
+
+        # Only downstream commits added since the old tip need to be checked
+        groups = [(full, downstream_patches)]
+        for old_tip, group in incremental.items():
+            if self.repo.is_ancestor_of(old_tip, state["tip"]):
+                new_ids = set(self.repo.obj.git.rev_list(f"{old_tip}..{state['tip']}").split())
+                groups.append(
+                    (group, [patch for patch in downstream_patches if patch.commitID in new_ids])
+                )
+            else:
+                full.extend(group)
+
+        incremental_count = sum(len(group) for group, _ in groups[1:])
+        LOGGER.info(
+            "Reusing %d stored match results, matching %d patches in full and %d incrementally",
+            len(patches) - len(full) - incremental_count,
+            len(full),
+            incremental_count,
+        )
+
+        # Load diffs for patches being matched in bulk, rather than one query per patch on access
+        matched_ids = [patch.patchID for group, _ in groups for patch in group]
+        for start in range(0, len(matched_ids), 1000):
+            end = start + 1000
+            session.query(PatchData).options(undefer(PatchData.commitDiffs)).filter(
+                PatchData.patchID.in_(matched_ids[start:end])
+            ).all()
+
+        evaluated = {}
+        mismatches = 0
+        stats = Counter()
+        for group, candidates in groups:
+            if not group:
+                continue
+
+            # Worker processes need plain records rather than database objects
+            records = group
+            if jobs > 1:
+                records = [
+                    PatchRecord(**{field: getattr(patch, field) for field in PATCH_DATA_FIELDS})
+                    for patch in group
+                ]
+            results, group_stats = match_patches(records, candidates, jobs, verify)
+            stats.update(group_stats)
+
+            for patch, (match, expected) in zip(group, results):
+                evaluated[patch.patchID] = match
+                if match is None:
+                    missing.append(patch.patchID)
+
+                if verify and getattr(match, "commitID", None) != expected:
+                    mismatches += 1
+                    LOGGER.warning(
+                        "Indexed matching differs for upstream %s: found %s, expected %s",
+                        patch.commitID,
+                        match,
+                        expected,
+                    )
+
+        LOGGER.info(
+            "Scored %d of %d patch pairs: %d fuzzy scores computed, %d avoided",
+            stats["candidates"],
+            stats["pairs"],
+            stats["fuzzy_computed"],
+            stats["fuzzy_avoided"],
+        )
+
+        return evaluated, missing, mismatches
@@ -4,14 +4,32 @@
 Functions to compare commits for similarities
 """
 
+import gc
+import hashlib
 import logging
 import os
-from typing import Iterable
+import re
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from functools import lru_cache
+from itertools import repeat
+from typing import Dict, Iterable, List, NamedTuple, Optional, Sequence, Set, Tuple
 
 from fuzzywuzzy import fuzz
+from fuzzywuzzy.utils import full_process
 
 from comma.database.model import PatchData
-from comma.util import PatchDiff
+from comma.util import PatchDiff, get_pool_context
+from comma.util.history import get_upstream_references
+
+
+try:
+    import numpy
+    from rapidfuzz import fuzz as rapid_fuzz
+    from rapidfuzz import process as rapid_process
+except ImportError:  # Optional dependencies, install with the "fast" extra
+    numpy = None
 
 
 LOGGER = logging.getLogger(__name__)
@@ -25,6 +43,72 @@ FILENAMES_WEIGHT = 0.2
 SUBJECT_WEIGHT = 0.48
 
 CONFIDENCE_THRESHOLD = 0.75  # Threshold that we must hit to return a match
+BOUND_TOLERANCE = 1e-9  # Allows for floating point error when stopping early
+
+# Candidate blocking
+AUTHOR_DATE_WINDOW = 1  # Days on either side of the upstream author date
+MAX_TOKEN_FRACTION = 0.1  # Subject tokens in more downstream patches than this aren't indexed
+MIN_TOKEN_PATCHES = 32  # Subject tokens in fewer downstream patches than this are always indexed
+RE_SUBJECT_TOKEN = re.compile(r"[a-z0-9_]+")
+MIN_SHA_LENGTH = 7  # Shortest abbreviated SHA accepted in upstream references
+FILEPATHS_CACHE_SIZE = 65536  # Distinct affected file lists kept split, see get_filepaths()
+
+# Increment when matching changes in a way the constants in get_matcher_version() don't capture
+MATCHER_REVISION = 1
+
+# Parallel matching
+SHARDS_PER_JOB = 4  # Upstream patches are split into more shards than jobs to balance load
+
+# Index of downstream patches in matching worker processes, see match_patches()
+WORKER_INDEX: Optional["DownstreamIndex"] = None
+
+# Batch scoring
+BATCH_AVAILABLE = numpy is not None
+BATCH_SLACK = 1.0  # Added to batch fuzzy scores to cover differences in rounding
+
+
+class Match(NamedTuple):
+    """
+    Downstream patch matching an upstream patch
+    method is "metadata" or "diff", score is the confidence or the percent of diff lines present
+    """
+
+    commitID: str
+    method: str
+    score: float
+
+
+def get_matcher_version(paths_version: str) -> str:
+    """
+    Get a digest of the settings which affect matching results
+    paths_version identifies the tracked paths, which determine the diffs compared
+    """
+
+    settings = (
+        MATCHER_REVISION,
+        AUTHOR_WEIGHT,
+        AUTHOR_DATE_WEIGHT,
+        COMMIT_DATE_WEIGHT,
+        DESCRIPTION_WEIGHT,
+        FILENAMES_WEIGHT,
+        SUBJECT_WEIGHT,
+        CONFIDENCE_THRESHOLD,
+        AUTHOR_DATE_WINDOW,
+        MAX_TOKEN_FRACTION,
+        MIN_TOKEN_PATCHES,
+        paths_version,
+    )
+    return hashlib.sha1(repr(settings).encode("utf-8")).hexdigest()
+
+
+@lru_cache(maxsize=FILEPATHS_CACHE_SIZE)
+def get_filepaths(affected_filenames: str) -> Tuple[str, ...]:
+    """
+    Split space-separated affected file names
+    Cached, since each downstream patch is compared against many upstream patches
+    """
+
+    return tuple(affected_filenames.split(" "))
 
 
 def calculate_filenames_confidence(
@@ -64,40 +148,503 @@ def calculate_filenames_confidence(
     return total_filepaths_match / len(upstream_filepaths)
 
 
-def patch_matches(downstream_patches: Iterable[PatchData], upstream: PatchData) -> bool:
-    """Check if 'upstream' has an equivalent in 'downstream_patches'."""
+def weigh_confidence(
+    author: float,
+    author_date: float,
+    commit_date: float,
+    description: float,
+    filenames: float,
+    subject: float,
+) -> float:
+    """Combine confidence components into overall confidence"""
 
-    # Preprocessing for matching filenames
-    upstream_filepaths = upstream.affectedFilenames.split(" ")
+    # Always sum in the same order, so results near the threshold don't change
+    return (
+        AUTHOR_WEIGHT * author
+        + AUTHOR_DATE_WEIGHT * author_date
+        + COMMIT_DATE_WEIGHT * commit_date
+        + DESCRIPTION_WEIGHT * description
+        + FILENAMES_WEIGHT * filenames
+        + SUBJECT_WEIGHT * subject
+    )
 
-    LOGGER.debug("Upstream missing patch, %s", upstream.commitID)
-    for downstream in downstream_patches:
-        # Calculate confidence that our upstream patch matches this downstream patch
 
-        author_confidence = fuzz.token_set_ratio(upstream.author, downstream.author) / 100.0
-        author_date_confidence = 1.0 if upstream.authorTime == downstream.authorTime else 0.0
-        commit_date_confidence = 1.0 if upstream.commitTime == downstream.commitTime else 0.0
+def get_confidence(downstream: PatchData, upstream: PatchData, upstream_filepaths) -> float:
+    """Calculate confidence that our upstream patch matches this downstream patch"""
+
+    return weigh_confidence(
+        fuzz.token_set_ratio(upstream.author, downstream.author) / 100.0,
+        1.0 if upstream.authorTime == downstream.authorTime else 0.0,
+        1.0 if upstream.commitTime == downstream.commitTime else 0.0,
         # Temporarily for description only checking exact string is in
-        description_confidence = 1.0 if upstream.description in downstream.description else 0.0
-        filenames_confidence = calculate_filenames_confidence(
-            downstream.affectedFilenames.split(" "), upstream_filepaths
+        1.0 if upstream.description in downstream.description else 0.0,
+        calculate_filenames_confidence(
+            get_filepaths(downstream.affectedFilenames), upstream_filepaths
+        ),
+        fuzz.partial_ratio(upstream.subject, downstream.subject) / 100.0,
+    )
+
+
+def meets_threshold(
+    downstream: PatchData,
+    upstream: PatchData,
+    upstream_filepaths: Sequence[str],
+    stats: Optional[Counter] = None,
+) -> bool:
+    """
+    Check if confidence that our upstream patch matches this downstream patch meets the threshold
+
+    Components are calculated from cheapest to most expensive while tracking the highest
+    confidence still possible. Remaining fuzzy scores are skipped once it drops below the
+    threshold. stats counts fuzzy scores computed and avoided.
+    """
+
+    stats = Counter() if stats is None else stats
+
+    author_date_confidence = 1.0 if upstream.authorTime == downstream.authorTime else 0.0
+    commit_date_confidence = 1.0 if upstream.commitTime == downstream.commitTime else 0.0
+    # Temporarily for description only checking exact string is in
+    description_confidence = 1.0 if upstream.description in downstream.description else 0.0
+
+    # Highest possible confidence, assuming fuzzy scores not calculated yet are perfect
+    bound = (
+        AUTHOR_DATE_WEIGHT * author_date_confidence
+        + COMMIT_DATE_WEIGHT * commit_date_confidence
+        + DESCRIPTION_WEIGHT * description_confidence
+        + AUTHOR_WEIGHT
+        + SUBJECT_WEIGHT
+        + FILENAMES_WEIGHT
+    )
+    if bound < CONFIDENCE_THRESHOLD - BOUND_TOLERANCE:
+        stats["fuzzy_avoided"] += 3
+        return False
+
+    author_confidence = fuzz.token_set_ratio(upstream.author, downstream.author) / 100.0
+    stats["fuzzy_computed"] += 1
+    bound -= AUTHOR_WEIGHT * (1.0 - author_confidence)
+    if bound < CONFIDENCE_THRESHOLD - BOUND_TOLERANCE:
+        stats["fuzzy_avoided"] += 2
+        return False
+
+    subject_confidence = fuzz.partial_ratio(upstream.subject, downstream.subject) / 100.0
+    stats["fuzzy_computed"] += 1
+    bound -= SUBJECT_WEIGHT * (1.0 - subject_confidence)
+    if bound < CONFIDENCE_THRESHOLD - BOUND_TOLERANCE:
+        stats["fuzzy_avoided"] += 1
+        return False
+
+    filenames_confidence = calculate_filenames_confidence(
+        get_filepaths(downstream.affectedFilenames), upstream_filepaths
+    )
+    stats["fuzzy_computed"] += 1
+
+    return (
+        weigh_confidence(
+            author_confidence,
+            author_date_confidence,
+            commit_date_confidence,
+            description_confidence,
+            filenames_confidence,
+            subject_confidence,
         )
-        subject_confidence = fuzz.partial_ratio(upstream.subject, downstream.subject) / 100.0
-
-        if (
-            AUTHOR_WEIGHT * author_confidence
-            + AUTHOR_DATE_WEIGHT * author_date_confidence
-            + COMMIT_DATE_WEIGHT * commit_date_confidence
-            + DESCRIPTION_WEIGHT * description_confidence
-            + FILENAMES_WEIGHT * filenames_confidence
-            + SUBJECT_WEIGHT * subject_confidence
-        ) >= CONFIDENCE_THRESHOLD:
-            return True
+        >= CONFIDENCE_THRESHOLD
+    )
+
+
+def find_metadata_match(
+    downstream_patches: Iterable[PatchData], upstream: PatchData, stats: Optional[Counter] = None
+) -> Optional[PatchData]:
+    """Find the first patch in 'downstream_patches' matching 'upstream' on metadata"""
+
+    # Preprocessing for matching filenames
+    upstream_filepaths = get_filepaths(upstream.affectedFilenames)
+
+    for downstream in downstream_patches:
+        if meets_threshold(downstream, upstream, upstream_filepaths, stats):
+            return downstream
+
+    return None
+
+
+def find_diff_match(
+    downstream_patches: Iterable[PatchData], upstream: PatchData
+) -> Optional[PatchData]:
+    """Find the first patch in 'downstream_patches' matching 'upstream' on code"""
+
+    upstream_diffs = PatchDiff(upstream.commitDiffs)
+    return next(
+        (
+            downstream
+            for downstream in downstream_patches
+            if upstream_diffs.percent_present_in(PatchDiff(downstream.commitDiffs))
+            > CONFIDENCE_THRESHOLD
+        ),
+        None,
+    )
+
+
+def find_match(downstream_patches: Sequence[PatchData], upstream: PatchData) -> Optional[PatchData]:
+    """Find the first equivalent of 'upstream' in 'downstream_patches'"""
+
+    LOGGER.debug("Upstream missing patch, %s", upstream.commitID)
+    if match := find_metadata_match(downstream_patches, upstream):
+        return match
 
     # TODO (Issue 53): just do this part?
     # Check for code matching
-    upstream_diffs = PatchDiff(upstream.commitDiffs)
-    return any(
-        upstream_diffs.percent_present_in(PatchDiff(downstream.commitDiffs)) > CONFIDENCE_THRESHOLD
-        for downstream in downstream_patches
+    return find_diff_match(downstream_patches, upstream)
+
+
+def patch_matches(downstream_patches: Iterable[PatchData], upstream: PatchData) -> bool:
+    """Check if 'upstream' has an equivalent in 'downstream_patches'."""
+
+    return find_match(downstream_patches, upstream) is not None
+
+
+def get_subject_tokens(subject: Optional[str]) -> Set[str]:
+    """Get normalized tokens from a subject for blocking"""
+
+    return {token for token in RE_SUBJECT_TOKEN.findall((subject or "").lower()) if len(token) > 2}
+
+
+def get_diff_lines(patch_diff: PatchDiff) -> Set[Tuple[str, str]]:
+    """Get distinct changed lines from a patch diff as (filename, line) pairs"""
+
+    return {
+        (filename, line)
+        for filename, (added, removed) in patch_diff.diffs.items()
+        for line in added | removed
+    }
+
+
+def get_day(timestamp: datetime) -> int:
+    """Get day number for a timestamp"""
+
+    return timestamp.toordinal()
+
+
+class ReferenceIndex:
+    """
+    Index of upstream commits referenced in downstream messages, e.g. "(cherry picked from
+    commit <sha>)". References may be abbreviated, so they are keyed by a short prefix.
+    """
+
+    def __init__(self, downstream_patches: Sequence[PatchData]) -> None:
+        self.downstream_patches = downstream_patches
+        self.references: Dict[str, List[Tuple[str, int]]] = defaultdict(list)
+
+        for num, downstream in enumerate(downstream_patches):
+            for sha in get_upstream_references(downstream.description):
+                self.references[sha[:MIN_SHA_LENGTH]].append((sha, num))
+
+    def find(self, upstream: PatchData) -> Optional[PatchData]:
+        """Find the first downstream patch which references 'upstream' in its message"""
+
+        return next(
+            (
+                self.downstream_patches[num]
+                for sha, num in sorted(
+                    self.references.get(upstream.commitID[:MIN_SHA_LENGTH], ()),
+                    key=lambda item: item[1],
+                )
+                if upstream.commitID.startswith(sha)
+            ),
+            None,
+        )
+
+
+class DownstreamIndex:
+    """
+    Index of downstream patches used to select match candidates for upstream patches
+
+    Candidates share a file basename or a subject token with the upstream patch, or were
+    authored within a day of it. Tokens which appear in many downstream patches don't
+    narrow candidates, so they are not indexed.
+
+    Blocking is a heuristic. A pair can meet the threshold without sharing a basename, an
+    indexed subject token or an author date, and such a match is missed here. Use
+    --verify-matching to check results against exhaustive matching.
+
+    Diff lines are indexed by file, so code matching only needs to count the lines each
+    downstream patch shares with the upstream patch. Each downstream diff is parsed once.
+    """
+
+    def __init__(self, downstream_patches: Sequence[PatchData]) -> None:
+        self.downstream_patches = downstream_patches
+        self.basenames: Dict[str, List[int]] = defaultdict(list)
+        self.tokens: Dict[str, List[int]] = defaultdict(list)
+        self.days: Dict[int, List[int]] = defaultdict(list)
+        self.diff_lines: Dict[Tuple[str, str], List[int]] = defaultdict(list)
+        # Counts of pairs, candidates, and fuzzy scores computed and avoided
+        self.stats = Counter()
+
+        for num, downstream in enumerate(downstream_patches):
+            for basename in {
+                os.path.basename(filepath)
+                for filepath in get_filepaths(downstream.affectedFilenames)
+            } - {""}:
+                self.basenames[basename].append(num)
+            for token in get_subject_tokens(downstream.subject):
+                self.tokens[token].append(num)
+            self.days[get_day(downstream.authorTime)].append(num)
+            for key in get_diff_lines(PatchDiff(downstream.commitDiffs)):
+                self.diff_lines[key].append(num)
+
+        max_token_patches = max(
+            MIN_TOKEN_PATCHES, int(len(downstream_patches) * MAX_TOKEN_FRACTION)
+        )
+        for token in [
+            token for token, nums in self.tokens.items() if len(nums) > max_token_patches
+        ]:
+            del self.tokens[token]
+
+    def get_candidate_nums(self, upstream: PatchData) -> List[int]:
+        """Get indices of downstream patches which may match upstream on metadata, in order"""
+
+        nums = set()
+        for basename in {
+            os.path.basename(filepath) for filepath in get_filepaths(upstream.affectedFilenames)
+        } - {""}:
+            nums.update(self.basenames.get(basename, ()))
+        for token in get_subject_tokens(upstream.subject):
+            nums.update(self.tokens.get(token, ()))
+        day = get_day(upstream.authorTime)
+        for offset in range(-AUTHOR_DATE_WINDOW, AUTHOR_DATE_WINDOW + 1):
+            nums.update(self.days.get(day + offset, ()))
+
+        return sorted(nums)
+
+    def find_diff_match(self, upstream: PatchData) -> Optional[Match]:
+        """
+        Find the first downstream patch matching 'upstream' on code
+        Equivalent to PatchDiff.percent_present_in() against every downstream patch
+        """
+
+        upstream_diffs = PatchDiff(upstream.commitDiffs)
+        if not upstream_diffs.total_lines or not self.downstream_patches:
+            return None
+
+        # Lines are compared as sets, but the total includes repeated lines
+        upstream_lines = get_diff_lines(upstream_diffs)
+        shared_lines = Counter()
+        for key in upstream_lines:
+            shared_lines.update(self.diff_lines.get(key, ()))
+
+        # When enough lines are repeated, any patch matches
+        nums = sorted(shared_lines)
+        if 1.0 - (len(upstream_lines) / upstream_diffs.total_lines) > CONFIDENCE_THRESHOLD:
+            nums = range(len(self.downstream_patches))
+
+        for num in nums:
+            percent = 1.0 - ((len(upstream_lines) - shared_lines[num]) / upstream_diffs.total_lines)
+            if percent > CONFIDENCE_THRESHOLD:
+                return Match(self.downstream_patches[num].commitID, "diff", percent)
+
+        return None
+
+    def find_match(
+        self, upstream: PatchData, bounds: Optional["ConfidenceBounds"] = None
+    ) -> Optional[Match]:
+        """
+        Find the first equivalent of 'upstream' among candidates
+        When bounds are given, candidates which can't reach the threshold are skipped
+        """
+
+        LOGGER.debug("Upstream missing patch, %s", upstream.commitID)
+        nums = self.get_candidate_nums(upstream)
+        if bounds is not None:
+            nums = bounds.filter(upstream, nums)
+        self.stats["pairs"] += len(self.downstream_patches)
+        self.stats["candidates"] += len(nums)
+
+        if match := find_metadata_match(
+            [self.downstream_patches[num] for num in nums], upstream, self.stats
+        ):
+            confidence = get_confidence(match, upstream, get_filepaths(upstream.affectedFilenames))
+            return Match(match.commitID, "metadata", confidence)
+
+        # TODO (Issue 53): just do this part?
+        # Check for code matching
+        return self.find_diff_match(upstream)
+
+
+class ConfidenceBounds:
+    """
+    Upper bounds on confidence for every pair of upstream and downstream patches
+
+    Author and subject similarity are scored in bulk with rapidfuzz, which finds alignments at
+    least as good as fuzzywuzzy's, and the remaining components are assumed to match.
+    Pairs with a bound below the threshold can't match, the rest are scored exactly,
+    so results are the same as scoring every pair.
+    Requires numpy and rapidfuzz, see BATCH_AVAILABLE.
+
+    workers: Threads used for bulk scoring, -1 uses all CPUs
+    """
+
+    def __init__(
+        self,
+        upstream_patches: Sequence[PatchData],
+        downstream_patches: Sequence[PatchData],
+        workers: int = -1,
+    ) -> None:
+        self.rows = {patch.commitID: num for num, patch in enumerate(upstream_patches)}
+
+        # Authors are processed the same way fuzzywuzzy's token_set_ratio() processes them
+        author_scores = get_score_matrix(
+            [full_process(patch.author, force_ascii=True) for patch in upstream_patches],
+            [full_process(patch.author, force_ascii=True) for patch in downstream_patches],
+            rapid_fuzz.token_set_ratio,
+            workers,
+        )
+        subject_scores = get_score_matrix(
+            [patch.subject or "" for patch in upstream_patches],
+            [patch.subject or "" for patch in downstream_patches],
+            rapid_fuzz.partial_ratio,
+            workers,
+        )
+
+        bounds = (
+            AUTHOR_WEIGHT * author_scores / 100.0
+            + SUBJECT_WEIGHT * subject_scores / 100.0
+            + AUTHOR_DATE_WEIGHT
+            + COMMIT_DATE_WEIGHT
+            + DESCRIPTION_WEIGHT
+            + FILENAMES_WEIGHT
+        )
+        self.may_match = bounds >= CONFIDENCE_THRESHOLD
+        LOGGER.debug(
+            "%d of %d patch pairs may match on metadata", self.may_match.sum(), self.may_match.size
+        )
+
+    def filter(self, upstream: PatchData, nums: Iterable[int]) -> List[int]:
+        """Filter indices of downstream patches to those which may match upstream"""
+
+        may_match = self.may_match[self.rows[upstream.commitID]]
+        return [num for num in nums if may_match[num]]
+
+
+def get_score_matrix(
+    queries: List[str], choices: List[str], scorer, workers: int = -1
+) -> "numpy.ndarray":
+    """
+    Score all pairs of strings in bulk, as upper bounds of the equivalent fuzzywuzzy scores
+    fuzzywuzzy scores identical strings as 100 even when empty
+    """
+
+    scores = rapid_process.cdist(
+        queries, choices, scorer=scorer, dtype=numpy.float64, workers=workers
+    )
+    scores += BATCH_SLACK
+    scores[numpy.array(queries, dtype=object)[:, None] == numpy.array(choices, dtype=object)] = 100
+    return numpy.minimum(scores, 100.0)
+
+
+def match_upstream(
+    index: DownstreamIndex,
+    upstream_patches: Sequence[PatchData],
+    verify: bool = False,
+    workers: int = -1,
+) -> Tuple[List[Tuple[Optional[Match], Optional[str]]], Counter]:
+    """
+    Match upstream patches against indexed downstream patches
+
+    Returns the match for each upstream patch, along with the commit ID of the exhaustive
+    match when verify is set, and counts from the index
+    workers: Threads used for bulk scoring, see ConfidenceBounds
+    """
+
+    # Score metadata in bulk to skip pairs which can't match, when available
+    bounds = (
+        ConfidenceBounds(upstream_patches, index.downstream_patches, workers)
+        if BATCH_AVAILABLE
+        else None
+    )
+
+    results = []
+    for upstream in upstream_patches:
+        match = index.find_match(upstream, bounds)
+        expected = find_match(index.downstream_patches, upstream) if verify else None
+        results.append((match, getattr(expected, "commitID", None)))
+
+    stats, index.stats = index.stats, Counter()
+    return results, stats
+
+
+def init_worker(downstream_patches: Sequence[PatchData]) -> None:
+    """
+    Index downstream patches in a matching worker process
+    Only used when workers can't be forked from the process holding the index
+    """
+
+    global WORKER_INDEX  # pylint: disable=global-statement
+
+    WORKER_INDEX = DownstreamIndex(downstream_patches)
+
+
+def match_shard(
+    upstream_patches: Sequence[PatchData], verify: bool = False
+) -> Tuple[List[Tuple[Optional[Match], Optional[str]]], Counter]:
+    """
+    Match a shard of upstream patches in a worker process, see match_upstream()
+    Each worker scores with a single thread, since workers already use every job
+    """
+
+    return match_upstream(WORKER_INDEX, upstream_patches, verify, workers=1)
+
+
+def match_patches(
+    upstream_patches: Sequence[PatchData],
+    downstream_patches: Sequence[PatchData],
+    jobs: int = 1,
+    verify: bool = False,
+) -> Tuple[List[Tuple[Optional[Match], Optional[str]]], Counter]:
+    """
+    Match upstream patches against downstream patches, see match_upstream()
+
+    With more than one job, upstream patches are split into shards matched in a process pool.
+    Patches must be picklable in that case. When workers can be forked, see get_pool_context(),
+    downstream patches are indexed once and workers inherit the index, so its pages are shared
+    copy-on-write until a worker writes to them. Otherwise, each worker indexes its own copy
+    of the corpus.
+    Results are returned in the same order as upstream_patches.
+    """
+
+    global WORKER_INDEX  # pylint: disable=global-statement
+
+    if jobs <= 1 or len(upstream_patches) <= 1:
+        return match_upstream(DownstreamIndex(downstream_patches), upstream_patches, verify)
+
+    shard_size = -(-len(upstream_patches) // (jobs * SHARDS_PER_JOB))
+    shards = []
+    for start in range(0, len(upstream_patches), shard_size):
+        end = start + shard_size
+        shards.append(upstream_patches[start:end])
+    LOGGER.debug(
+        "Matching %d patches with %d jobs in %d shards", len(upstream_patches), jobs, len(shards)
     )
+
+    context = get_pool_context()
+    if context.get_start_method() == "fork":
+        WORKER_INDEX = DownstreamIndex(downstream_patches)
+        # Keep the garbage collector from writing to inherited objects in workers
+        gc.freeze()
+        pool_options = {"mp_context": context}
+    else:
+        pool_options = {
+            "mp_context": context,
+            "initializer": init_worker,
+            "initargs": (list(downstream_patches),),
+        }
+
+    results = []
+    stats = Counter()
+    try:
+        with ProcessPoolExecutor(max_workers=min(jobs, len(shards)), **pool_options) as executor:
+            for shard_results, shard_stats in executor.map(match_shard, shards, repeat(verify)):
+                results.extend(shard_results)
+                stats.update(shard_stats)
+    finally:
+        WORKER_INDEX = None
+        gc.unfreeze()
+
+    return results, stats
@@ -4,14 +4,28 @@
 Functions for parsing commit objects into patch objects
 """
 
+import hashlib
 import logging
+from typing import List, Optional
 
-from comma.database.model import PatchData
+from comma.database.model import PatchData, PatchDataHashes, PatchFiles, UpstreamWatermarks
+from comma.util.history import PatchRecord
+from comma.util.tracking import get_paths_version
 
 
 LOGGER = logging.getLogger(__name__)
 
 
+def get_watermark_version(paths_version: str, since: Optional[str]) -> str:
+    """
+    Get a digest of the settings which determine the upstream commits walked
+    Changing either tracked paths or upstream since invalidates the watermark, so commits
+    outside the previous window are ingested
+    """
+
+    return hashlib.sha1(f"{paths_version}\n{since or ''}".encode("utf-8")).hexdigest()
+
+
 class Upstream:
     """
     Parent object for downstream operations
@@ -22,63 +36,231 @@ class Upstream:
         self.database = database
         self.repo = repo
 
-    def process_commits(self, force_update=False):
+    def process_commits(self, force_update=False, batch_size=500, jobs=1):
         """
         Generate patches for commits affecting tracked paths
+
+        Known commit IDs are loaded in a single query and patches are written in batches of
+        batch_size commits, one transaction per batch. Commits are parsed by jobs processes.
+
+        Only commits since the last processed commit are walked unless the watermark is no longer
+        an ancestor of the reference, the tracked paths or upstream since changed, or force_update
+        is set.
         """
 
         paths = self.repo.get_tracked_paths(self.config.upstream.sections)
+        paths_version = get_paths_version(paths)
+        watermark_version = get_watermark_version(paths_version, self.config.upstream_since)
+        reference = self.config.upstream.reference
+        head = self.repo.commit(f"origin/{reference}").hexsha
+        rev = f"origin/{reference}"
+        if not force_update and (watermark := self.get_watermark(watermark_version, head)):
+            LOGGER.info("Processing upstream commits since %s", watermark)
+            rev = f"{watermark}..{rev}"
+
         added = 0
         updated = 0
         total = 0
 
-        # We use `--min-parents=1 --max-parents=1` to avoid both merges and graft commits.
+        # Load all known commit IDs up front rather than querying for each commit
+        with self.database.get_session() as session:
+            known_commits = {commit_id for (commit_id,) in session.query(PatchData.commitID)}
+        LOGGER.debug("Found %d patches in database", len(known_commits))
+
+        new_records: List[PatchRecord] = []
+        existing_records: List[PatchRecord] = []
+
         LOGGER.info("Determining upstream commits from tracked files")
-        for commit in self.repo.iter_commits(
-            rev=f"origin/{self.config.upstream.reference}",
-            paths=paths,
-            min_parents=1,
-            max_parents=1,
+        for record in self.repo.iter_patch_records(
+            rev,
+            paths,
             since=self.config.upstream_since,
+            jobs=jobs,
         ):
             total += 1
-            with self.database.get_session() as session:
-                # Query database for commit
-                if force_update:
-                    query = session.query(PatchData)
-                else:
-                    query = session.query(PatchData.commitID)
-                patch = query.filter_by(commitID=commit.hexsha).one_or_none()
-
-                # If commit is missing, add it
-                if patch is None:
-                    session.add(PatchData.create(commit, paths))
-                    added += 1
-
-                # If commit is present, optionally update
-                elif force_update:
-                    # Get a local patch object
-                    patch_data = PatchData.create(commit, paths)
-
-                    # Iterate through the columns
-                    record_updated = False
-                    for column in (
-                        col.name for col in patch_data.__table__.columns if not col.primary_key
-                    ):
-                        # Skip commit ID
-                        if column == "commitID":
-                            continue
-
-                        # If the new value is different, update it
-                        new_value = getattr(patch_data, column)
-                        if getattr(patch, column) != new_value:
-                            LOGGER.info("Updating %s for %s", column, commit.hexsha)
-                            setattr(patch, column, new_value)
-                            record_updated = True
-
-                    if record_updated:
-                        updated += 1
+
+            # If commit is missing, add it
+            if record.commitID not in known_commits:
+                new_records.append(record)
+                if len(new_records) >= batch_size:
+                    added += self.add_patches(new_records, paths_version)
+                    new_records = []
+
+            # If commit is present, optionally update
+            elif force_update:
+                existing_records.append(record)
+                if len(existing_records) >= batch_size:
+                    updated += self.update_patches(existing_records, paths_version)
+                    existing_records = []
+
+        # Write out remaining partial batches
+        if new_records:
+            added += self.add_patches(new_records, paths_version)
+        if existing_records:
+            updated += self.update_patches(existing_records, paths_version)
 
         LOGGER.info("%d of %d patches added to database.", added, total)
         if force_update:
             LOGGER.info("%d of %d patches updated in database.", updated, total)
+
+        self.set_watermark(watermark_version, head)
+
+    def get_watermark(self, watermark_version: str, head: str) -> Optional[str]:
+        """
+        Get the last processed commit for the upstream reference if it can be used for head
+        watermark_version: See get_watermark_version()
+        """
+
+        reference = self.config.upstream.reference
+        with self.database.get_session() as session:
+            watermark = session.query(UpstreamWatermarks).filter_by(reference=reference).first()
+            if watermark is None:
+                return None
+            commit_id = watermark.commitID
+            stored_version = watermark.pathsVersion
+
+        if stored_version != watermark_version:
+            LOGGER.info("Tracked paths or upstream since changed, processing all upstream commits")
+            return None
+
+        if not self.repo.is_ancestor_of(commit_id, head):
+            LOGGER.info(
+                "Last processed commit %s is not an ancestor of origin/%s, "
+                "processing all upstream commits",
+                commit_id,
+                reference,
+            )
+            return None
+
+        return commit_id
+
+    def set_watermark(self, watermark_version: str, head: str) -> None:
+        """
+        Record head as the last processed commit for the upstream reference
+        watermark_version: See get_watermark_version()
+        """
+
+        reference = self.config.upstream.reference
+        with self.database.get_session() as session:
+            watermark = session.query(UpstreamWatermarks).filter_by(reference=reference).first()
+            if watermark is None:
+                session.add(
+                    UpstreamWatermarks(
+                        reference=reference, pathsVersion=watermark_version, commitID=head
+                    )
+                )
+            else:
+                watermark.pathsVersion = watermark_version
+                watermark.commitID = head
+
+        LOGGER.debug("Upstream watermark for %s set to %s", reference, head)
+
+    def add_patches(self, records: List[PatchRecord], paths_version: str) -> int:
+        """
+        Add a batch of new patches to the database in a single transaction
+        Patches are inserted in bulk, then their IDs are read back to insert their hashes
+        """
+
+        with self.database.get_session() as session:
+            self.database.bulk_insert(
+                session, PatchData, [record.get_columns() for record in records]
+            )
+
+            patch_ids = {}
+            commit_ids = [record.commitID for record in records]
+            # Stay well below MSSQL's limit on bound parameters
+            for start in range(0, len(commit_ids), 1000):
+                end = start + 1000
+                patch_ids.update(
+                    session.query(PatchData.commitID, PatchData.patchID).filter(
+                        PatchData.commitID.in_(commit_ids[start:end])
+                    )
+                )
+
+            self.database.bulk_insert(
+                session,
+                PatchDataHashes,
+                [
+                    {
+                        "patchID": patch_ids[record.commitID],
+                        "contentHash": record.get_content_hash(),
+                        "pathsVersion": paths_version,
+                    }
+                    for record in records
+                ],
+            )
+            self.database.bulk_insert(
+                session,
+                PatchFiles,
+                [
+                    row
+                    for record in records
+                    for row in PatchFiles.get_rows(patch_ids[record.commitID], record.affectedPaths)
+                ],
+            )
+
+        LOGGER.debug("Added batch of %d patches to database", len(records))
+        return len(records)
+
+    def update_patches(self, records: List[PatchRecord], paths_version: str) -> int:
+        """
+        Update a batch of existing patches in a single transaction
+
+        Stored content hashes are compared in bulk, so only patches that changed are read back
+        and rewritten. Returns the number of patches that changed.
+        """
+
+        records_by_id = {record.commitID: record for record in records}
+        hashes = {record.commitID: record.get_content_hash() for record in records}
+        patch_updates = []
+        hash_updates = []
+        hash_inserts = []
+        file_inserts = []
+
+        with self.database.get_session() as session:
+            stored = []
+            commit_ids = list(records_by_id)
+            # Stay well below MSSQL's limit on bound parameters
+            for start in range(0, len(commit_ids), 1000):
+                end = start + 1000
+                stored.extend(
+                    session.query(
+                        PatchData.commitID,
+                        PatchData.patchID,
+                        PatchDataHashes.contentHash,
+                        PatchDataHashes.pathsVersion,
+                    )
+                    .outerjoin(PatchData.hashes)
+                    .filter(PatchData.commitID.in_(commit_ids[start:end]))
+                )
+
+            for commit_id, patch_id, content_hash, stored_paths_version in stored:
+                if content_hash == hashes[commit_id] and stored_paths_version == paths_version:
+                    continue
+
+                LOGGER.info("Updating patch for %s", commit_id)
+                values = records_by_id[commit_id].get_columns()
+                del values["commitID"]
+                patch_updates.append({"_patchID": patch_id, **values})
+                file_inserts.extend(
+                    PatchFiles.get_rows(patch_id, records_by_id[commit_id].affectedPaths)
+                )
+
+                hash_values = {"contentHash": hashes[commit_id], "pathsVersion": paths_version}
+                if content_hash is None:
+                    hash_inserts.append({"patchID": patch_id, **hash_values})
+                else:
+                    hash_updates.append({"_patchID": patch_id, **hash_values})
+
+            # Write changes as bulk statements rather than tracking changes on ORM objects
+            self.database.bulk_update(session, PatchData, "patchID", patch_updates)
+            self.database.bulk_update(session, PatchDataHashes, "patchID", hash_updates)
+            self.database.bulk_insert(session, PatchDataHashes, hash_inserts)
+
+            # Replace affected files for changed patches
+            self.database.bulk_delete(
+                session, PatchFiles, [{"patchID": row["_patchID"]} for row in patch_updates]
+            )
+            self.database.bulk_insert(session, PatchFiles, file_inserts)
+
+        return len(patch_updates)
@@ -4,7 +4,10 @@
 Utility functions and classes
 """
 
+import multiprocessing
+import threading
 from datetime import datetime
+from multiprocessing.context import BaseContext
 
 import approxidate
 
@@ -20,6 +23,18 @@ class DateString(str):
         self.datetime = datetime.utcfromtimestamp(self.epoch)
 
 
+def format_diff(path: str, diff: bytes) -> str:
+    """
+    Format the diff for a single file into a string
+    Only added and removed lines are kept
+    """
+
+    lines = "\n".join(
+        line for line in diff.decode("utf-8").splitlines() if line.startswith(("+", "-"))
+    )
+    return f"{path}\n{lines}"
+
+
 def format_diffs(commit, paths):
     """
     Format diffs from commit object into string
@@ -30,12 +45,7 @@ def format_diffs(commit, paths):
     for diff in commit.tree.diff(commit.parents[0], paths=paths, create_patch=True):
         if diff.a_path is not None:
             # The patch commit diffs are stored as "(filename1)\n(diff1)\n(filename2)\n(diff2)..."
-            lines = "\n".join(
-                line
-                for line in diff.diff.decode("utf-8").splitlines()
-                if line.startswith(("+", "-"))
-            )
-            diffs.append(f"{diff.a_path}\n{lines}")
+            diffs.append(format_diff(diff.a_path, diff.diff))
 
     return "\n".join(diffs)
 
@@ -83,3 +93,16 @@ class PatchDiff:
                 missing_lines += len(added) + len(removed)
 
         return 1.0 - (missing_lines / self.total_lines)
+
+
+def get_pool_context() -> BaseContext:
+    """
+    Get the multiprocessing context for process pools
+    Workers are forked when possible. Forking while other threads run copies any locks they
+    hold into workers, so workers are spawned instead in that case.
+    """
+
+    if "fork" in multiprocessing.get_all_start_methods() and threading.active_count() == 1:
+        return multiprocessing.get_context("fork")
+
+    return multiprocessing.get_context("spawn")
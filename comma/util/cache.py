@@ -0,0 +1,90 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+"""
+Persistent on-disk caches
+"""
+
+import json
+import sqlite3
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, Mapping
+
+
+class DiskCache:
+    """
+    Persistent key-value store backed by a local SQLite file
+    Each cache is a named table in the file and values are stored as JSON
+    """
+
+    def __init__(self, path: Path, name: str) -> None:
+        if not name.isidentifier():
+            raise ValueError(f"Invalid cache name: '{name}'")
+
+        self.path = path
+        self.name = name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        with self.connection:
+            self.connection.execute(
+                f"CREATE TABLE IF NOT EXISTS {name} (key TEXT PRIMARY KEY, value TEXT NOT NULL)"
+            )
+
+    def __len__(self) -> int:
+        return self.connection.execute(f"SELECT COUNT(*) FROM {self.name}").fetchone()[0]
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        """
+        Get values for the given keys, keys that are not cached are omitted
+        """
+
+        keys = tuple(keys)
+        found = {}
+        # Stay well below SQLite's limit on bound parameters
+        for start in range(0, len(keys), 500):
+            end = start + 500
+            batch = keys[start:end]
+            found.update(
+                (key, json.loads(value))
+                for key, value in self.connection.execute(
+                    f"SELECT key, value FROM {self.name} "
+                    f"WHERE key IN ({', '.join('?' * len(batch))})",
+                    batch,
+                )
+            )
+
+        return found
+
+    def set_many(self, items: Mapping[str, Any]) -> None:
+        """
+        Store values for the given keys in a single transaction
+        """
+
+        with self.connection:
+            self.connection.executemany(
+                f"INSERT OR REPLACE INTO {self.name} (key, value) VALUES (?, ?)",
+                ((key, json.dumps(value)) for key, value in items.items()),
+            )
+
+    def delete_many(self, keys: Iterable[str]) -> None:
+        """
+        Remove the given keys in a single transaction
+        """
+
+        with self.connection:
+            self.connection.executemany(
+                f"DELETE FROM {self.name} WHERE key = ?", ((key,) for key in keys)
+            )
+
+    def keys(self) -> Iterator[str]:
+        """
+        Iterate through all cached keys
+        """
+
+        return (key for (key,) in self.connection.execute(f"SELECT key FROM {self.name}"))
+
+    def close(self) -> None:
+        """
+        Close the underlying database connection
+        """
+
+        self.connection.close()
@@ -0,0 +1,521 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+"""
+Streaming parser for patch data from git history
+"""
+
+import hashlib
+import logging
+import re
+import subprocess
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from itertools import zip_longest
+from pathlib import Path
+from typing import IO, Any, Dict, Iterable, Iterator, List, NamedTuple, Optional, Sequence, Tuple
+
+from comma.util import format_diff, get_pool_context
+
+
+LOGGER = logging.getLogger(__name__)
+
+IGNORED_IN_CMSG = "reported-by:", "signed-off-by:", "reviewed-by:", "acked-by:", "cc:"
+
+# Header fields are NUL-delimited, so multi-line messages can be read back unambiguously
+PATCH_FORMAT = "%x00%H%x00%an%x00%ae%x00%at%x00%ct%x00%B%x00"
+RAW_FORMAT = "%x00%H%x00"
+
+# Maximum number of commits parsed per process pool task
+MAX_CHUNK_SIZE = 256
+
+# Header lines which may appear between "diff --git" and the first hunk
+DIFF_HEADER_PREFIXES = (
+    b"old mode ",
+    b"new mode ",
+    b"similarity index ",
+    b"dissimilarity index ",
+    b"rename from ",
+    b"rename to ",
+    b"copy from ",
+    b"copy to ",
+    b"new file mode ",
+    b"deleted file mode ",
+    b"index ",
+    b"--- ",
+    b"+++ ",
+)
+
+# Lines in downstream commit messages referencing the upstream commit, e.g.
+# "(cherry picked from commit <sha>)", "(backported from commit <sha> linux-next)",
+# "commit <sha> upstream.", "[ Upstream commit <sha> ]"
+RE_UPSTREAM_REFERENCE = re.compile(
+    r"^(?:\((?:cherry picked|backported) from commit ([0-9a-f]{7,40})\b[^)]*\)"
+    r"|commit ([0-9a-f]{7,40}) upstream\.?"
+    r"|\[\s*upstream commit ([0-9a-f]{7,40})\s*\])$",
+    re.IGNORECASE | re.MULTILINE,
+)
+RE_DIFF_GIT = re.compile(rb'^diff --git ("?[ab]/.+?"?) ("?[ab]/.+?"?)$')
+RE_QUOTED_CHAR = re.compile(rb"\\([0-7]{3}|.)")
+QUOTED_ESCAPES = {b"a": 7, b"b": 8, b"f": 12, b"n": 10, b"r": 13, b"t": 9, b"v": 11}
+
+# pylint: disable=invalid-name
+
+
+class PatchRecord(NamedTuple):
+    """
+    Plain data for a patch/commit, field names match the PatchData columns
+
+    affectedPaths is not a column, it holds the parsed affected file names for PatchFiles,
+    since the space-separated affectedFilenames column is ambiguous for paths with spaces.
+    It is empty for records created from PatchData rows.
+    """
+
+    commitID: str
+    subject: Optional[str]
+    description: str
+    author: str
+    authorEmail: str
+    authorTime: datetime
+    commitTime: datetime
+    affectedFilenames: str
+    commitDiffs: str
+    fixedPatches: str
+    affectedPaths: Tuple[str, ...] = ()
+
+    def get_columns(self) -> Dict[str, Any]:
+        """
+        Get values for the PatchData columns
+        """
+
+        return {field: getattr(self, field) for field in PATCH_DATA_FIELDS}
+
+    def get_content_hash(self) -> str:
+        """
+        Get a digest of all columns derived from the commit
+        affectedPaths is excluded, it is derived from the same output as affectedFilenames
+        """
+
+        content = hashlib.sha1()
+        for value in self.get_columns().values():
+            content.update(str(value).encode("utf-8", "surrogateescape"))
+            content.update(b"\0")
+
+        return content.hexdigest()
+
+    def to_json(self) -> list:
+        """
+        Convert to a JSON-serializable list of field values
+        """
+
+        return [value.isoformat() if isinstance(value, datetime) else value for value in self]
+
+    @classmethod
+    def from_json(cls, values: list) -> "PatchRecord":
+        """
+        Create from a list of field values produced by to_json()
+        """
+
+        record = cls(*values)
+        return record._replace(
+            authorTime=datetime.fromisoformat(record.authorTime),
+            commitTime=datetime.fromisoformat(record.commitTime),
+            affectedPaths=tuple(record.affectedPaths),
+        )
+
+
+# pylint: enable=invalid-name
+
+# PatchRecord fields stored as PatchData columns
+PATCH_DATA_FIELDS = tuple(field for field in PatchRecord._fields if field != "affectedPaths")
+
+
+def parse_message(message: str) -> Tuple[Optional[str], str, str]:
+    """
+    Parse a commit message into subject, description, and fixed patches
+    """
+
+    subject = None
+    description = []
+    fixed_patches = []
+    for num, line in enumerate(message.splitlines()):
+        line = line.strip()  # pylint: disable=redefined-loop-name
+        if not num:
+            subject = line
+            continue
+
+        if line.lower().startswith(IGNORED_IN_CMSG):
+            continue
+
+        description.append(line)
+
+        # Check if this patch fixes other patches
+        if line.lower().startswith("fixes:"):
+            words = line.split(" ")
+            if len(words) > 1:
+                fixed_patches.append(words[1])
+
+    # e.g. "SHA1 SHA2 SHA3"
+    return subject, "\n".join(description), " ".join(fixed_patches)
+
+
+def get_upstream_references(message: str) -> List[str]:
+    """
+    Get upstream commit SHAs referenced by lines in a commit message
+    References may be abbreviated
+    """
+
+    return [
+        next(sha for sha in match if sha).lower()
+        for match in RE_UPSTREAM_REFERENCE.findall(message)
+    ]
+
+
+def unquote_path(path: bytes) -> str:
+    """
+    Decode a path from git output, undoing C-style quoting if present
+    """
+
+    if path.startswith(b'"') and path.endswith(b'"'):
+        path = RE_QUOTED_CHAR.sub(
+            lambda match: bytes(
+                (
+                    int(match[1], 8)
+                    if len(match[1]) == 3
+                    else QUOTED_ESCAPES.get(match[1], ord(match[1])),
+                )
+            ),
+            path[1:-1],
+        )
+
+    return path.decode("utf-8", "replace")
+
+
+def git_command(repo_path: Path, command: str, *args: str) -> List[str]:
+    """
+    Build a git command line with stable output settings
+    """
+
+    return [
+        "git",
+        "-C",
+        str(repo_path),
+        "-c",
+        "core.quotePath=false",
+        "-c",
+        "diff.noprefix=false",
+        "-c",
+        "diff.mnemonicPrefix=false",
+        command,
+        "--no-color",
+        "--no-ext-diff",
+        "--no-textconv",
+        *args,
+    ]
+
+
+def git_log(repo_path: Path, *args: str) -> subprocess.Popen:
+    """
+    Start a git log process with stable output settings
+    """
+
+    command = git_command(repo_path, "log", "--no-show-signature", "--encoding=UTF-8", *args)
+    LOGGER.debug("Running command: %s", command)
+    return subprocess.Popen(command, stdout=subprocess.PIPE)  # pylint: disable=consider-using-with
+
+
+def finish_process(process: subprocess.Popen) -> None:
+    """
+    Wait for a process to end, raising if it failed
+    """
+
+    if process.wait():
+        raise subprocess.CalledProcessError(process.returncode, process.args)
+
+
+def iter_log_entries(
+    stream: IO[bytes], log_format: str
+) -> Iterator[Tuple[List[bytes], List[bytes]]]:
+    """
+    Split git log output into header fields and the lines following each header
+    """
+
+    delimiters = log_format.count("%x00")
+    fields = None
+    lines: List[bytes] = []
+    header = b""
+
+    for line in stream:
+        # Headers start with a NUL and span lines until all delimiters are seen
+        if header or line.startswith(b"\0"):
+            header += line
+            if header.count(b"\0") < delimiters:
+                continue
+
+            if fields is not None:
+                yield fields, lines
+            fields = header.split(b"\0")[1:delimiters]
+            lines = []
+            header = b""
+            continue
+
+        lines.append(line)
+
+    if fields is not None:
+        yield fields, lines
+
+
+def parse_raw_filenames(lines: Iterable[bytes]) -> List[str]:
+    """
+    Get all paths from raw diff lines, including both sides of renames
+    """
+
+    filenames = set()
+    for line in lines:
+        if line.startswith(b":"):
+            filenames.update(
+                unquote_path(path) for path in line.rstrip(b"\n").split(b"\t")[1:] if path
+            )
+
+    return sorted(filenames)
+
+
+def parse_patch(lines: Iterable[bytes]) -> str:
+    """
+    Parse reversed patch output into the stored commit diff format
+
+    Output matches comma.util.format_diffs(), which diffs a commit's tree against its parent,
+    so the patch must be generated with -R and the "old" side is the commit side.
+    """
+
+    diffs = []
+    path = None
+    body: List[bytes] = []
+    in_header = False
+
+    def finish_file():
+        if path is not None:
+            diffs.append(format_diff(path, b"".join(body)))
+
+    for line in lines:
+        if line.startswith(b"diff --git "):
+            finish_file()
+            match = RE_DIFF_GIT.match(line.rstrip(b"\n"))
+            fallback = unquote_path(match[1])[2:] if match else None
+            path = fallback
+            path_line = rename_from = None
+            body = []
+            in_header = True
+            continue
+
+        if in_header:
+            if line.startswith(DIFF_HEADER_PREFIXES):
+                if line.startswith(b"--- "):
+                    path_line = line[4:].rstrip(b"\t\n\r\f\v")
+                elif line.startswith(b"rename from "):
+                    rename_from = line[12:].rstrip(b"\n")
+
+                # Prefer path from "---" line, then rename source, then "diff --git" line
+                if path_line is not None:
+                    path = None if path_line == b"/dev/null" else unquote_path(path_line)[2:]
+                elif rename_from is not None:
+                    path = unquote_path(rename_from)
+                continue
+
+            in_header = False
+
+        body.append(line)
+
+    finish_file()
+    return "\n".join(diffs)
+
+
+def iter_log_records(repo_path: Path, paths: Iterable[str], *args: str) -> Iterator[PatchRecord]:
+    """
+    Stream patch records for the commits selected by args
+
+    Two git log processes are read in lockstep: one producing path-limited patches and one
+    producing the full list of affected files. Memory use is bounded by the largest commit.
+    """
+
+    paths = tuple(paths)
+    patches = git_log(repo_path, "-R", "-M", "-p", f"--format={PATCH_FORMAT}", *args, "--", *paths)
+    raw = git_log(
+        repo_path, "-M", "--raw", "--full-diff", f"--format={RAW_FORMAT}", *args, "--", *paths
+    )
+
+    try:
+        for patch_entry, raw_entry in zip_longest(
+            iter_log_entries(patches.stdout, PATCH_FORMAT), iter_log_entries(raw.stdout, RAW_FORMAT)
+        ):
+            if patch_entry is None or raw_entry is None or patch_entry[0][0] != raw_entry[0][0]:
+                raise RuntimeError("git log output is out of sync")
+
+            (sha, author, email, authored, committed, message), lines = patch_entry
+            subject, description, fixed_patches = parse_message(message.decode("utf-8", "replace"))
+            affected_paths = parse_raw_filenames(raw_entry[1])
+
+            yield PatchRecord(
+                commitID=sha.decode(),
+                subject=subject,
+                description=description,
+                author=author.decode("utf-8", "replace"),
+                authorEmail=email.decode("utf-8", "replace"),
+                authorTime=datetime.utcfromtimestamp(int(authored)),
+                commitTime=datetime.utcfromtimestamp(int(committed)),
+                affectedFilenames=" ".join(affected_paths),
+                commitDiffs=parse_patch(lines),
+                fixedPatches=fixed_patches,
+                affectedPaths=tuple(affected_paths),
+            )
+
+        finish_process(patches)
+        finish_process(raw)
+
+    finally:
+        for process in (patches, raw):
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            process.stdout.close()
+
+
+def get_patch_records(
+    repo_path: Path, shas: Sequence[str], paths: Iterable[str]
+) -> List[PatchRecord]:
+    """
+    Get patch records for specific commits, in the order given
+    Module-level so it can be used as a process pool task
+    """
+
+    return list(iter_log_records(repo_path, paths, "--no-walk=unsorted", *shas))
+
+
+def rev_list(
+    repo_path: Path, rev: str, paths: Iterable[str], since: Optional[str] = None
+) -> List[str]:
+    """
+    List non-merge commits affecting paths, newest first
+    """
+
+    # We use `--min-parents=1 --max-parents=1` to avoid both merges and graft commits.
+    command = ["git", "-C", str(repo_path), "rev-list", "--min-parents=1", "--max-parents=1"]
+    if since:
+        command.append(f"--since={since}")
+    command.extend((rev, "--", *paths))
+
+    LOGGER.debug("Running command: %s", command)
+    return subprocess.run(command, stdout=subprocess.PIPE, check=True, text=True).stdout.split()
+
+
+def iter_commit_records(
+    repo_path: Path, shas: Sequence[str], paths: Iterable[str], jobs: int = 1
+) -> Iterator[PatchRecord]:
+    """
+    Stream patch records for specific commits, in the order given
+
+    Commits are split into chunks to bound command line length. With more than one job,
+    chunks are parsed in a process pool. Each worker runs its own git processes and records
+    are yielded in the same order.
+    """
+
+    paths = tuple(paths)
+
+    if jobs <= 1:
+        for start in range(0, len(shas), MAX_CHUNK_SIZE):
+            end = start + MAX_CHUNK_SIZE
+            yield from get_patch_records(repo_path, shas[start:end], paths)
+        return
+
+    # Use enough chunks to keep all workers busy, but keep them large enough to amortize startup
+    chunk_size = max(1, min(MAX_CHUNK_SIZE, -(-len(shas) // (jobs * 4))))
+    LOGGER.debug("Parsing %d commits with %d jobs in chunks of %d", len(shas), jobs, chunk_size)
+
+    with ProcessPoolExecutor(max_workers=jobs, mp_context=get_pool_context()) as executor:
+        # Limit chunks in flight so memory stays bounded if the consumer is slower than the pool
+        pending = deque()
+        for start in range(0, len(shas), chunk_size):
+            end = start + chunk_size
+            pending.append(executor.submit(get_patch_records, repo_path, shas[start:end], paths))
+            if len(pending) >= jobs * 2:
+                yield from pending.popleft().result()
+
+        while pending:
+            yield from pending.popleft().result()
+
+
+def iter_patch_records(
+    repo_path: Path, rev: str, paths: Iterable[str], since: Optional[str] = None, jobs: int = 1
+) -> Iterator[PatchRecord]:
+    """
+    Stream patch records for non-merge commits affecting paths, newest first
+    With more than one job, commits are parsed in a process pool
+    """
+
+    paths = tuple(paths)
+
+    if jobs <= 1:
+        # We use `--min-parents=1 --max-parents=1` to avoid both merges and graft commits.
+        args = ["--min-parents=1", "--max-parents=1"]
+        if since:
+            args.append(f"--since={since}")
+        yield from iter_log_records(repo_path, paths, *args, rev)
+        return
+
+    yield from iter_commit_records(repo_path, rev_list(repo_path, rev, paths, since), paths, jobs)
+
+
+def get_patch_ids(repo_path: Path, shas: Iterable[str]) -> Dict[str, Optional[str]]:
+    """
+    Compute stable patch IDs for the given commits
+
+    Patches are streamed from `git diff-tree` into `git patch-id`, so each commit is diffed once.
+    Commits without changes have no patch ID and map to None.
+    """
+
+    shas = tuple(shas)
+    patch_ids: Dict[str, Optional[str]] = dict.fromkeys(shas)
+    if not shas:
+        return patch_ids
+
+    command = git_command(repo_path, "diff-tree", "--stdin", "-p")
+    LOGGER.debug("Running command: %s", command)
+    # pylint: disable=consider-using-with
+    diff_tree = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    patch_id = subprocess.Popen(
+        ["git", "-C", str(repo_path), "patch-id", "--stable"],
+        stdin=diff_tree.stdout,
+        stdout=subprocess.PIPE,
+    )
+    # pylint: enable=consider-using-with
+    diff_tree.stdout.close()  # Only patch-id reads from diff-tree
+
+    # Feed commits from a thread so a full output pipe can't block the input
+    def feed():
+        try:
+            diff_tree.stdin.write("".join(f"{sha}\n" for sha in shas).encode())
+        finally:
+            diff_tree.stdin.close()
+
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+
+    try:
+        # Output lines are "<patch-id> <commit>"
+        for line in patch_id.stdout:
+            value, sha = line.decode().split()
+            patch_ids[sha] = value
+
+        feeder.join()
+        finish_process(diff_tree)
+        finish_process(patch_id)
+
+    finally:
+        for process in (diff_tree, patch_id):
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+        patch_id.stdout.close()
+
+    return patch_ids
@@ -18,8 +18,14 @@ from openpyxl.formula.translate import Translator
 from openpyxl.styles import DEFAULT_FONT
 from openpyxl.workbook.workbook import Workbook
 from openpyxl.worksheet.worksheet import Worksheet
-
-from comma.database.model import MonitoringSubjects, MonitoringSubjectsMissingPatches, PatchData
+from sqlalchemy import exists, or_
+
+from comma.database.model import (
+    MonitoringSubjects,
+    MonitoringSubjectsMissingPatches,
+    PatchData,
+    PatchFiles,
+)
 from comma.exceptions import CommaSpreadsheetError
 
 
@@ -158,9 +164,14 @@ class Spreadsheet:
         with self.database.get_session() as session:
             query = session.query(PatchData.commitID, PatchData.patchID)
 
+            # Excluded paths are LIKE patterns matched against each affected file
             if excluded_paths:
-                for entry in excluded_paths:
-                    query = query.filter(~PatchData.affectedFilenames.like(entry))
+                query = query.filter(
+                    ~exists().where(
+                        PatchFiles.patchID == PatchData.patchID,
+                        or_(*(PatchFiles.path.like(entry) for entry in excluded_paths)),
+                    )
+                )
 
             if since:
                 query = query.filter(PatchData.commitTime >= since)
@@ -281,10 +292,12 @@ class Spreadsheet:
                     continue
 
                 # Update “Fixes” column.
-                patch = session.query(PatchData).filter_by(patchID=patch_id).one()
+                fixed_patches = (
+                    session.query(PatchData.fixedPatches).filter_by(patchID=patch_id).scalar()
+                )
                 # The database stores these separated by a space, but we want commas
                 worksheet.get_cell("Fixes", commit_cell.row).value = (
-                    ", ".join(patch.fixedPatches.split()) if patch.fixedPatches else None
+                    ", ".join(fixed_patches.split()) if fixed_patches else None
                 )
 
                 # Query for subjects missing patch. Only missing is tracked
@@ -13,6 +13,7 @@ from comma.database.model import PatchData
 
 
 LOGGER = logging.getLogger(__name__)
+SYMBOLS_BATCH_SIZE = 100  # Commits whose symbols are saved per transaction
 
 
 def get_symbols(repo_dir, files):
@@ -88,6 +89,7 @@ class Symbols:
 
         # Preserve initial reference
         initial_reference = self.repo.head.reference
+        updates = []
 
         try:
             self.repo.checkout(prev_commit)
@@ -110,18 +112,30 @@ class Symbols:
                 if diff_symbols:
                     print(f"Commit: {commit} -> {' '.join(diff_symbols)}")
 
-                # Save symbols to database
-                with self.database.get_session() as session:
-                    patch = session.query(PatchData).filter_by(commitID=commit).one()
-                    patch.symbols = " ".join(diff_symbols)
+                # Save symbols to database in batches
+                updates.append({"_commitID": commit, "symbols": " ".join(diff_symbols)})
+                if len(updates) >= SYMBOLS_BATCH_SIZE:
+                    self.save_symbols(updates)
+                    updates = []
 
                 # Use symbols from current commit to compare to next commit
                 before_patch_apply = after_patch_apply
 
+            self.save_symbols(updates)
+
         finally:
             # Reset reference
             self.repo.checkout(initial_reference)
 
+    def save_symbols(self, updates):
+        """
+        Save symbols for a batch of commits in a single transaction
+        updates: Rows with a "_commitID" and the "symbols" to set for it
+        """
+
+        with self.database.get_session() as session:
+            self.database.bulk_update(session, PatchData, "commitID", updates)
+
     def symbol_checker(self, file_path: Path):
         """
         This function returns missing symbols by comparing database patch symbols with given symbols
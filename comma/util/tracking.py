@@ -4,19 +4,34 @@
 Functions and classes for fetching and parsing data from Git
 """
 
+import hashlib
 import logging
 import pathlib
 import re
-from typing import Any, Iterable, List, Optional, Set, Tuple
+import threading
+import time
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple
 from urllib.parse import urlparse
 
 import git
 
 from comma.util import DateString
+from comma.util.cache import DiskCache
+from comma.util.history import (
+    PatchRecord,
+    get_patch_ids,
+    iter_commit_records,
+    iter_patch_records,
+    rev_list,
+)
 
 
 LOGGER = logging.getLogger(__name__)
 
+# Shallow fetches hold a repository's shallow.lock for the whole download, so they are
+# serialized per repository rather than left to retry on the lock
+SHALLOW_FETCH_LOCKS: Dict[pathlib.Path, threading.Lock] = {}
+
 
 class GitRetry:
     """
@@ -31,9 +46,13 @@ class GitRetry:
         "remote: Path translation timed out",
     )
 
-    def __init__(self, func: callable, max_tries: int = 3):
+    # Another git process holds a lock in the repo, e.g. a ref lock or shallow.lock
+    lock_errors = (".lock': File exists",)
+
+    def __init__(self, func: callable, max_tries: int = 3, lock_delay: float = 5.0):
         self.func = func
         self.max_tries = max_tries
+        self.lock_delay = lock_delay
 
     def __call__(self, *args: Any, **kwargs: Any) -> Any:
         for tries in range(1, self.max_tries + 1):
@@ -56,6 +75,12 @@ class GitRetry:
                 if any(error in e.stderr for error in self.errors):
                     LOGGER.warning("Likely transient error, retrying: %s", e)
 
+                # Wait for lock to be released, backing off exponentially
+                elif any(error in e.stderr for error in self.lock_errors):
+                    delay = self.lock_delay * 2 ** (tries - 1)
+                    LOGGER.warning("Repository is locked, retrying in %gs: %s", delay, e)
+                    time.sleep(delay)
+
                 else:
                     # Raise on anything else
                     raise
@@ -79,6 +104,14 @@ def get_filenames(commit: git.Commit) -> List[str]:
     )
 
 
+def get_paths_version(paths: Iterable[str]) -> str:
+    """
+    Get a digest identifying a set of tracked paths
+    """
+
+    return hashlib.sha1("\n".join(sorted(set(paths))).encode("utf-8")).hexdigest()
+
+
 class Repo:
     """
     Common repository operations
@@ -122,6 +155,8 @@ class Repo:
                 self.fetch(repack=True)
             else:
                 raise
+        else:
+            self.write_commit_graph()
 
     def clone(self, since: Optional[str] = None):
         """Clone repo"""
@@ -135,6 +170,34 @@ class Repo:
 
         self.obj = git.Repo.clone_from(self.url, self.path, **args, progress=GitProgressPrinter())
         LOGGER.info("Completed cloning %s", self.name)
+        self.write_commit_graph()
+
+    def write_commit_graph(self):
+        """
+        Update commit-graph with changed-path Bloom filters for faster path-limited queries
+        Layers are split, so only commits added since the last write are processed
+
+        Git ignores commit-graphs in shallow repos, so none is written for them. Downstream refs
+        are fetched into the same repo, so a downstream since date makes it shallow as well.
+        """
+
+        if self.is_shallow:
+            LOGGER.warning(
+                "Not writing commit-graph for %s, git ignores commit-graphs in shallow repos. "
+                "Path-limited history queries will be slower. Shallow history comes from "
+                "upstream or downstream since dates",
+                self.name,
+            )
+            return
+
+        LOGGER.info("Writing commit-graph for %s", self.name)
+        try:
+            self.obj.git.commit_graph("write", "--reachable", "--changed-paths", "--split")
+        except git.GitCommandError as e:
+            # The commit-graph only speeds up queries, so failing to write it isn't fatal
+            LOGGER.warning("Failed to write commit-graph for %s: %s", self.name, e)
+            return
+        LOGGER.info("Completed writing commit-graph for %s", self.name)
 
     def pull(self, ref: Optional[str] = None):
         """Pull repo"""
@@ -149,6 +212,21 @@ class Repo:
         """Convenience property to see if repo abject has been populated"""
         return self.obj is not None
 
+    @property
+    def is_shallow(self) -> bool:
+        """Check if repo has shallow history"""
+        return pathlib.Path(self.obj.git_dir, "shallow").exists()
+
+    @property
+    def shallow_fetch_lock(self) -> threading.Lock:
+        """Lock serializing shallow fetches into this repo across threads"""
+        return SHALLOW_FETCH_LOCKS.setdefault(self.path, threading.Lock())
+
+    @property
+    def cache_path(self) -> pathlib.Path:
+        """Path to the persistent cache file for this repo"""
+        return pathlib.Path(self.obj.git_dir, "comma", "cache.db")
+
     def get_tracked_paths(self, sections) -> Tuple[str]:
         """Get list of files from MAINTAINERS for given sections."""
 
@@ -167,130 +245,311 @@ class Repo:
         ]
         refs.append(f"origin/{self.default_ref}")  # Include default reference
 
-        for ref in refs:
-            paths |= extract_paths(sections, self.obj.git.show(f"{ref}:MAINTAINERS"))
+        # Resolve all MAINTAINERS blobs at once, unchanged files share a blob across refs
+        blobs = set(self.obj.git.rev_parse(*(f"{ref}:MAINTAINERS" for ref in refs)).split())
+
+        # Parsed paths are cached by blob and sections, so only new blobs need to be read
+        sections_key = hashlib.sha1("\n".join(sorted(sections)).encode("utf-8")).hexdigest()
+        cache = DiskCache(self.cache_path, "maintainers")
+        try:
+            cached = cache.get_many(f"{blob}:{sections_key}" for blob in blobs)
+            parsed = {}
+            for blob in blobs:
+                key = f"{blob}:{sections_key}"
+                if key in cached:
+                    paths.update(cached[key])
+                    continue
+
+                # Blobs are read through a single persistent `git cat-file --batch` process
+                content = self.obj.git.get_object_data(blob)[3].decode("utf-8", "replace")
+                parsed[key] = sorted(extract_paths(sections, content))
+                paths.update(parsed[key])
+
+            LOGGER.debug("Parsed %d of %d MAINTAINERS blobs", len(parsed), len(blobs))
+            cache.set_many(parsed)
+        finally:
+            cache.close()
 
         LOGGER.debug("Completed parsing MAINTAINERS file for %s", self.name)
         self._tracked_paths = tuple(sorted(paths))
 
         return self._tracked_paths
 
-    def fetch_remote_ref(
-        self, remote: str, local_ref: str, remote_ref: str, since: Optional[DateString] = None
-    ) -> None:
+    def iter_patch_records(
+        self, rev: str, paths: Iterable[str], since: Optional[str] = None, jobs: int = 1
+    ) -> Iterator[PatchRecord]:
         """
-        Shallow fetch remote reference so it is available locally
+        Stream patch records for non-merge commits affecting paths from a single pass of git log
+        When jobs is greater than 1, commits are parsed in parallel by a process pool
         """
 
-        local_sha = None
-        remote_sha = None
-        kwargs = {"verbose": True, "progress": GitProgressPrinter()}
-        remote = self.obj.remote(remote)
-        fetch = GitRetry(remote.fetch)
-
-        # Check if we already have a local reference
-        if hasattr(self.obj.references, local_ref):
-            local_ref_obj = self.obj.references[local_ref]
-            local_sha = (
-                local_ref_obj.object.hexsha
-                if hasattr(local_ref_obj, "object")
-                else local_ref_obj.commit.hexsha
+        return iter_patch_records(self.path, rev, paths, since=since, jobs=jobs)
+
+    def get_cached_patch_records(
+        self, rev: str, paths: Iterable[str], since: Optional[str] = None, jobs: int = 1
+    ) -> List[PatchRecord]:
+        """
+        Get patch records for non-merge commits affecting paths, newest first
+        Records are cached by commit and tracked paths, so each commit is only parsed once
+        When jobs is greater than 1, uncached commits are parsed in parallel by a process pool
+        """
+
+        paths = tuple(paths)
+        paths_version = get_paths_version(paths)
+        shas = rev_list(self.path, rev, paths, since)
+
+        cache = DiskCache(self.cache_path, "patch_records")
+        try:
+            cached = cache.get_many(f"{sha}:{paths_version}" for sha in shas)
+            records = {
+                key.split(":", 1)[0]: PatchRecord.from_json(value) for key, value in cached.items()
+            }
+
+            if missing := [sha for sha in shas if sha not in records]:
+                LOGGER.debug("Parsing %d of %d commits", len(missing), len(shas))
+                parsed = {}
+                for record in iter_commit_records(self.path, missing, paths, jobs):
+                    records[record.commitID] = record
+                    parsed[f"{record.commitID}:{paths_version}"] = record.to_json()
+                cache.set_many(parsed)
+        finally:
+            cache.close()
+
+        return [records[sha] for sha in shas]
+
+    def evict_patch_records(self, refs: Iterable[str], paths: Iterable[str]) -> None:
+        """
+        Remove cached patch records for commits no longer reachable from refs
+        Records for other tracked paths are also removed
+        """
+
+        paths = tuple(paths)
+        paths_version = get_paths_version(paths)
+        refs = [ref for ref in refs if hasattr(self.obj.references, ref)]
+        reachable = set(
+            self.obj.git.rev_list("--min-parents=1", "--max-parents=1", *refs, "--", *paths).split()
+            if refs
+            else ()
+        )
+
+        cache = DiskCache(self.cache_path, "patch_records")
+        try:
+            evicted = []
+            for key in cache.keys():
+                sha, version = key.split(":", 1)
+                if version != paths_version or sha not in reachable:
+                    evicted.append(key)
+
+            LOGGER.debug("Evicting %d of %d cached patch records", len(evicted), len(cache))
+            cache.delete_many(evicted)
+        finally:
+            cache.close()
+
+    def is_ancestor_of(self, ancestor: str, rev: str) -> bool:
+        """
+        Check if ancestor is reachable from rev
+        Commits that are not available locally are never ancestors
+        """
+
+        try:
+            return self.obj.is_ancestor(ancestor, rev)
+        except git.GitCommandError:
+            return False
+
+    def fetch_remote_refs(
+        self, remote: str, refs: Dict[str, str], since: Optional[DateString] = None
+    ) -> Dict[str, git.GitCommandError]:
+        """
+        Shallow fetch remote references so they are available locally
+        All references are fetched together, so shared objects are only downloaded once
+        Git aborts the whole fetch if any reference can't be fetched, so when fetching them
+        together fails, each reference is fetched on its own
+
+        refs: Mapping of local reference names to remote reference names
+        Returns errors for local references which couldn't be fetched
+        """
+
+        try:
+            self._fetch_remote_refs(remote, refs, since)
+            return {}
+        except git.GitCommandError as e:
+            if len(refs) == 1:
+                return {local_ref: e for local_ref in refs}
+            LOGGER.warning(
+                "Failed to fetch refs %s from remote %s together, fetching separately: %s",
+                ", ".join(refs.values()),
+                remote,
+                e,
             )
 
-            # If we have the ref locally, we still want to update, but give negotiation hint
-            kwargs["negotiation_tip"] = local_ref
+        errors = {}
+        for local_ref, remote_ref in refs.items():
+            try:
+                self._fetch_remote_refs(remote, {local_ref: remote_ref}, since)
+            except git.GitCommandError as e:
+                errors[local_ref] = e
 
-            # Get remote ref so we can check against the local ref
-            if output := self.obj.git.ls_remote(remote, remote_ref):
-                remote_sha = output.split()[0]
+        return errors
+
+    def _fetch_remote_refs(
+        self, remote: str, refs: Dict[str, str], since: Optional[DateString] = None
+    ) -> None:
+        """
+        Shallow fetch remote references in a single fetch, see fetch_remote_refs()
+        Shallow fetches hold the repository's shallow.lock, so they are serialized between
+        threads, other fetches may run concurrently
+        """
+
+        local_shas = {}
+        remote_shas = {}
+        kwargs = {"verbose": True, "progress": GitProgressPrinter()}
+        remote = self.obj.remote(remote)
+        # Allow extra tries since concurrent fetches may contend for locks
+        fetch = GitRetry(remote.fetch, max_tries=5)
+        # Fetch directly into local tags to preserve references locally
+        # FETCH_HEAD is not used since it is shared between concurrent fetches
+        refspecs = {
+            local_ref: f"+{remote_ref}:refs/tags/{local_ref}"
+            for local_ref, remote_ref in refs.items()
+        }
+
+        # Check if we already have local references
+        for local_ref in refs:
+            if hasattr(self.obj.references, local_ref):
+                local_ref_obj = self.obj.references[local_ref]
+                local_shas[local_ref] = (
+                    local_ref_obj.object.hexsha
+                    if hasattr(local_ref_obj, "object")
+                    else local_ref_obj.commit.hexsha
+                )
+
+        if local_shas:
+            # If we have refs locally, we still want to update, but give negotiation hints
+            kwargs["negotiation_tip"] = list(local_shas)
+
+            # Get remote refs so we can check against the local refs
+            advertised = [
+                line.split()
+                for line in self.obj.git.ls_remote(remote, *set(refs.values())).splitlines()
+            ]
+            for local_ref, remote_ref in refs.items():
+                remote_shas[local_ref] = next(
+                    (
+                        sha
+                        for sha, name in advertised
+                        if name == remote_ref or name.endswith(f"/{remote_ref}")
+                    ),
+                    None,
+                )
 
         # No fetch window specified
         # Or using Azure DevOps since it doesn't support shallow-since or unshallow
         if not since or any(
             urlparse(url).hostname == "msazure.visualstudio.com" for url in remote.urls
         ):
-            LOGGER.info("Fetching ref %s from remote %s", remote_ref, remote)
-            fetch(remote_ref, **kwargs)
-
-            # Create tag at FETCH_HEAD to preserve reference locally
-            if local_sha is None or local_sha != remote_sha:
-                self.obj.create_tag(local_ref, "FETCH_HEAD", force=True)
-
+            LOGGER.info("Fetching refs %s from remote %s", ", ".join(refs.values()), remote)
+            fetch(list(refspecs.values()), **kwargs)
             return
 
-        # If we have the ref locally, see if the ref is the same to avoid resetting depth
-        if local_sha and remote_sha == local_sha:
-            commit_date = self.obj.references[local_ref].commit.committed_date
-
-        # Otherwise, initially fetch revision at depth 1. This will reset local depth
-        else:
-            LOGGER.info("Fetching remote ref %s from remote %s at depth 1", remote_ref, remote)
-            fetch_info = fetch(remote_ref, depth=1, **kwargs)[-1]
-            commit_date = fetch_info.commit.committed_date
+        # If we have a ref locally, see if the ref is the same to avoid resetting depth
+        # Otherwise, initially fetch revisions at depth 1. This will reset local depth
+        if stale := [
+            local_ref
+            for local_ref in refs
+            if local_ref not in local_shas or remote_shas[local_ref] != local_shas[local_ref]
+        ]:
+            LOGGER.info(
+                "Fetching remote refs %s from remote %s at depth 1",
+                ", ".join(refs[local_ref] for local_ref in stale),
+                remote,
+            )
+            with self.shallow_fetch_lock:
+                fetch([refspecs[local_ref] for local_ref in stale], depth=1, **kwargs)
 
         # If last commit for revision is in the fetch window, expand depth
         # This check is necessary because some servers will throw an error when there are
         # no commits in the fetch window
-        if commit_date >= since.epoch:
-            LOGGER.info(
-                'Fetching ref %s from remote %s shallow since "%s"',
-                remote_ref,
-                remote,
-                since,
-            )
+        in_window = []
+        for local_ref, remote_ref in refs.items():
+            if self.obj.commit(f"refs/tags/{local_ref}").committed_date >= since.epoch:
+                in_window.append(local_ref)
+            else:
+                LOGGER.info(
+                    'Newest commit for ref %s from remote %s is older than fetch window "%s"',
+                    remote_ref,
+                    remote,
+                    since,
+                )
+
+        if not in_window:
+            return
+
+        LOGGER.info(
+            'Fetching refs %s from remote %s shallow since "%s"',
+            ", ".join(refs[local_ref] for local_ref in in_window),
+            remote,
+            since,
+        )
+        window_refspecs = [refspecs[local_ref] for local_ref in in_window]
+        with self.shallow_fetch_lock:
             try:
-                fetch(remote_ref, shallow_since=since, **kwargs)
+                fetch(window_refspecs, shallow_since=since, **kwargs)
             except git.GitCommandError as e:
                 # ADO repos do not currently support --shallow-since, only depth
                 if "Server does not support --shallow-since" in e.stderr:
                     LOGGER.warning(
                         "Server does not support --shallow-since, retrying fetch without option."
                     )
-                    fetch(remote_ref, **kwargs)
+                    fetch(window_refspecs, **kwargs)
                 else:
                     raise
-        else:
-            LOGGER.info(
-                'Newest commit for ref %s from remote %s is older than fetch window "%s"',
-                remote_ref,
-                remote,
-                since,
-            )
 
-        # Create tag at FETCH_HEAD to preserve reference locally
-        if local_sha is None or local_sha != remote_sha:
-            self.obj.create_tag(local_ref, "FETCH_HEAD", force=True)
+    def get_patch_ids(self, shas: Iterable[str]) -> Dict[str, Optional[str]]:
+        """
+        Get stable patch IDs for commits from the persistent index
+        Patch IDs are only computed for commits which haven't been seen before
+        """
+
+        shas = set(shas)
+        cache = DiskCache(self.cache_path, "patch_id")
+        try:
+            patch_ids = cache.get_many(shas)
+            if missing := shas.difference(patch_ids):
+                LOGGER.debug("Computing patch IDs for %d commits", len(missing))
+                computed = get_patch_ids(self.path, missing)
+                cache.set_many(computed)
+                patch_ids.update(computed)
+        finally:
+            cache.close()
+
+        return patch_ids
 
     def get_missing_cherries(self, reference, paths, since: Optional[str] = None):
         """
         Get a list of cherry-picked commits missing from the downstream reference
         """
 
-        args = ["--no-merges", "--pretty=format:%H"]
+        args = ["--no-merges"]
         if since:
             args.append(f"--since={since}")
+        upstream_ref = f"origin/{self.default_ref}"
 
         # Get all upstream commits on tracked paths within window
-        upstream_commits = set(
-            self.obj.git.log(
-                *args,
-                f"origin/{self.default_ref}",
-                "--",
-                paths,
-            ).splitlines()
-        )
+        upstream_commits = set(self.obj.git.rev_list(*args, upstream_ref, "--", paths).split())
 
-        # Get missing cherries for all paths, but don't filter by path since it takes forever
-        missing_cherries = set(
-            self.obj.git.log(
-                *args,
-                "--right-only",
-                "--cherry-pick",
-                f"{reference}...origin/{self.default_ref}",
-            ).splitlines()
+        # Equivalent to `git log --right-only --cherry-pick reference...upstream_ref`
+        # Patch IDs come from the index rather than being recomputed for every reference
+        downstream_only = self.obj.git.rev_list(*args, f"{upstream_ref}..{reference}").split()
+        candidates = upstream_commits.intersection(
+            self.obj.git.rev_list(*args, f"{reference}..{upstream_ref}").split()
         )
+        if not candidates:
+            return candidates
+
+        patch_ids = self.get_patch_ids(candidates.union(downstream_only))
+        downstream_ids = {patch_ids[sha] for sha in downstream_only} - {None}
 
-        return missing_cherries & upstream_commits
+        return {sha for sha in candidates if patch_ids[sha] not in downstream_ids}
 
     def get_remote_tags(self, remote: str):
         """
@@ -129,6 +129,20 @@ def symbols(session: nox.Session) -> None:
         )
 
 
+@nox.session(python=CURRENT_PYTHON)
+def benchmark(session: nox.Session) -> None:
+    """Benchmark path-limited history queries against an existing repo"""
+    session.install(".", silent=False)
+    session.run("python", "-m", "comma.benchmark.history", *session.posargs)
+
+
+@nox.session(python=CURRENT_PYTHON)
+def benchmark_matcher(session: nox.Session) -> None:
+    """Benchmark downstream matching on synthetic or recorded corpora"""
+    session.install(".[fast]", silent=False)
+    session.run("python", "-m", "comma.benchmark.matcher", *session.posargs)
+
+
 # --- Utility ---
 
 